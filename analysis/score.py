@@ -0,0 +1,155 @@
+import argparse
+import json
+import math
+import os
+import re
+from collections import defaultdict
+
+# Names of the groups in the dataset, as in the paper
+groups = {
+    "Euskal gaiak": "local",
+    "Gai orokorrak": "global",
+    "Nazioarteko gaiak": "global",
+}
+
+
+class Accuracy:
+    def __init__(self):
+        self.n = 0
+        self.correct = 0
+
+    def add(self, correct):
+        self.n += 1
+        self.correct += bool(correct)
+
+    @property
+    def acc(self):
+        return self.correct / self.n
+
+    @property
+    def stderr(self):
+        # Standard error of the mean with the sample variance, as in lm_eval
+        if self.n < 2:
+            return float("nan")
+        return math.sqrt(self.acc * (1 - self.acc) / (self.n - 1))
+
+
+def slug(value):
+    return re.sub(r"\W+", "_", str(value).lower()).strip("_")
+
+
+def find_results(paths):
+    # Evaluator outputs in the given files and directories, without the shards
+    # and the dead letters next to them
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, _, names in sorted(os.walk(path)):
+            for name in sorted(names):
+                if re.fullmatch(r"bertaqa_.+_\d+-shot\.jsonl", name):
+                    yield os.path.join(directory, name)
+
+
+def score_file(path):
+    # Read one item at a time, only the counts are kept in memory
+    overall = Accuracy()
+    subsets = defaultdict(Accuracy)
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # Cut short by a crash, the evaluator drops it on resume
+                break
+            item = json.loads(line)
+            overall.add(item["correct"])
+            group = groups.get(item["group"], item["group"])
+            for dimension, value in [
+                ("group", group),
+                ("category", item["category"]),
+                ("difficulty", item["difficulty"]),
+            ]:
+                subsets[dimension, value].add(item["correct"])
+    return overall, subsets
+
+
+def summarize(path):
+    # Same shape as the results of lm_eval, with the subsets as subtasks
+    model = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    match = re.match(r"(bertaqa_.+)_(\d+)-shot", os.path.basename(path))
+    if match is None:
+        raise ValueError(f"{path} is not named like bertaqa_<config>_<shots>-shot")
+    task, shots = match.group(1), int(match.group(2))
+
+    overall, subsets = score_file(path)
+    if not overall.n:
+        raise ValueError(f"No items in {path}")
+    results = {
+        task: {
+            "acc,none": overall.acc,
+            "acc_stderr,none": overall.stderr,
+            "alias": task,
+        }
+    }
+    dimensions = ["group", "category", "difficulty"]
+    for dimension, value in sorted(
+        subsets, key=lambda x: (dimensions.index(x[0]), str(x[1]))
+    ):
+        accuracy = subsets[dimension, value]
+        results[f"{task}_{dimension}_{slug(value)}"] = {
+            "acc,none": accuracy.acc,
+            "acc_stderr,none": accuracy.stderr,
+            "alias": f" - {dimension} {value}",
+        }
+    return {
+        "results": results,
+        "n-samples": {task: {"original": overall.n, "effective": overall.n}},
+        "n-shot": {task: shots},
+        "config": {"model": model},
+    }
+
+
+def main():
+    # Define the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths",
+        type=str,
+        nargs="+",
+        help="Result jsonl files of the evaluators, or directories to search for them",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write the summaries to this json file, keyed by result file",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="Also write each summary as a json file next to its result file",
+    )
+    args = parser.parse_args()
+
+    summaries = {}
+    for path in find_results(args.paths):
+        summary = summarize(path)
+        summaries[path] = summary
+        if args.write:
+            with open(os.path.splitext(path)[0] + ".json", "w") as f:
+                json.dump(summary, f, indent=2)
+
+        model = summary["config"]["model"]
+        shots = next(iter(summary["n-shot"].values()))
+        for result in summary["results"].values():
+            print(
+                f"{model:<30} {shots}-shot {result['alias']:<40} "
+                f"{result['acc,none']:.4f} ± {result['acc_stderr,none']:.4f}"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,165 +1,970 @@
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
+from anthropic.types import Message, Usage
+from local_batch import LocalBatchClient
+import asyncio
 import os
-from datasets import load_dataset
-import random
+import sys
 import argparse
+import functools
 import json
+import time
+from datetime import datetime, timezone
+from statistics import NormalDist
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_random_exponential,
 )  # for exponential backoff
 
-seed = 42
-random.seed(seed)
+# The code shared by the evaluators of every provider is in common/
+common_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"
+)
+sys.path.insert(0, common_dir)
+import evaluation
+from evaluation import (
+    FewShotSampler,
+    ResponseCache,
+    ResultWriter,
+    Telemetry,
+    answer2letter,
+    check_cache_prefix,
+    draw_few_shots,
+    estimate_tokens,
+    get_rate_limiter,
+    load_bertaqa,
+    load_completed_ids,
+    load_completed_parquet_ids,
+    load_correct,
+    load_spent,
+    merge_shards,
+    new_call_stats,
+    parse_answer,
+    read_results,
+    print_plan,
+    shard_path,
+    sort_results,
+    stratified_order,
+    wait_for_rate_limit,
+    wilson_interval,
+    write_dead_letter,
+)
 
 # Set your Anthropic API key from environment variable
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# Retries are left to completion_with_backoff, so they are paced by the rate
+# limiter and counted in the telemetry
+client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
+async_client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
 
-answer2letter = {0: "A", 1: "B", 2: "C"}
+# Prices per model are kept in a registry next to this script
+pricing_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing.json")
 
+# Message Batches requests are billed at half the synchronous price
+batch_discount = 0.5
 
-def load_bertaqa(config="eu"):
-    dataset = load_dataset("HiTZ/bertaqa", name=config, split="test")
-    return dataset
+# Prompt cache writes and reads are billed relative to the input token price
+cache_write_multiplier = 1.25
+cache_read_multiplier = 0.1
 
 
-def format_question(item, config="eu"):
-    question = item["question"]
-    candidates = item["candidates"]
-
-    # Format the question with the given prompt
-    if config == "eu":
-        formatted_question = f"Galdera: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nErantzuna:"
-    elif config in ["en", "en_mt"]:
-        formatted_question = f"Question: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nAnswer:"
-    else:
-        raise ValueError("config must be 'eu', 'en' or 'en_mt'")
-    return formatted_question
+def cache_minimum(model):
+    # Shortest prefix that is cached, in tokens
+    return 2048 if "haiku" in model else 1024
 
 
-def few_shot_messages(few_shot_examples, config="eu"):
+def few_shot_messages(few_shot_indices, sampler, cache=False):
     # Add the few-shot examples to the prompt
     messages = []
-    for example in few_shot_examples:
-        messages.append({"role": "user", "content": format_question(example, config)})
-        messages.append(
-            {"role": "assistant", "content": answer2letter[example["answer"]]}
-        )
+    for j in few_shot_indices:
+        messages.append({"role": "user", "content": sampler.questions[j]})
+        messages.append({"role": "assistant", "content": sampler.letters[j]})
+    if cache and messages:
+        # Cache breakpoint after the last few-shot example
+        messages[-1]["content"] = [
+            {
+                "type": "text",
+                "text": messages[-1]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ]
     return messages
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return client.messages.create(**kwargs)
-
-
-def anthropic_api_calculate_cost(usage, model="claude-3-sonnet-20240229"):
-    pricing = {
-        "claude-3-opus-20240229": {
-            "prompt": 0.015,
-            "completion": 0.075,
-        },
-        "claude-3-sonnet-20240229": {
-            "prompt": 0.003,
-            "completion": 0.015,
-        },
-        "claude-3-haiku-20240307": {
-            "prompt": 0.00025,
-            "completion": 0.00125,
-        }
-    }
+def parse_reset(value):
+    # Reset times are RFC 3339 timestamps
+    reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+
+
+def rate_limit_headers(headers):
+    limits = {}
+    for key in ["requests_limit", "requests_remaining", "tokens_limit", "tokens_remaining"]:
+        value = headers.get("anthropic-ratelimit-" + key.replace("_", "-"))
+        if value is not None:
+            kind, name = key.split("_")
+            limits[f"{name}_{kind}"] = int(value)
+    for kind in ["requests", "tokens"]:
+        value = headers.get(f"anthropic-ratelimit-{kind}-reset")
+        if value is not None:
+            limits[f"reset_{kind}"] = parse_reset(value)
+    return limits
+
+
+# Calls of every model in this run
+telemetry = Telemetry()
+
+
+@retry(wait=wait_for_rate_limit, stop=stop_after_attempt(6))
+def completion_with_backoff(stats=None, **kwargs):
+    limiter = get_rate_limiter(kwargs["model"])
+    estimated = estimate_tokens(kwargs)
+    started = time.perf_counter()
+    limiter.acquire(estimated)
+    throttle = time.perf_counter() - started
+    raw = client.messages.with_raw_response.create(**kwargs)
+    completion = raw.parse()
+    limiter.update(rate_limit_headers(raw.headers))
+    limiter.record(estimated, usage_tokens(completion.usage))
+    if stats is not None:
+        stats["status"] = raw.status_code
+        stats["throttle"] += throttle
+        stats["completion_tokens"] = completion.usage.output_tokens
+        stats["prompt_tokens"] = (
+            usage_tokens(completion.usage) - stats["completion_tokens"]
+        )
+    return completion
+
+
+@retry(wait=wait_for_rate_limit, stop=stop_after_attempt(6))
+async def async_completion_with_backoff(stats=None, **kwargs):
+    limiter = get_rate_limiter(kwargs["model"])
+    estimated = estimate_tokens(kwargs)
+    started = time.perf_counter()
+    await limiter.acquire_async(estimated)
+    throttle = time.perf_counter() - started
+    raw = await async_client.messages.with_raw_response.create(**kwargs)
+    completion = raw.parse()
+    limiter.update(rate_limit_headers(raw.headers))
+    limiter.record(estimated, usage_tokens(completion.usage))
+    if stats is not None:
+        stats["status"] = raw.status_code
+        stats["throttle"] += throttle
+        stats["completion_tokens"] = completion.usage.output_tokens
+        stats["prompt_tokens"] = (
+            usage_tokens(completion.usage) - stats["completion_tokens"]
+        )
+    return completion
+
+
+@functools.lru_cache(maxsize=None)
+def load_pricing(path=pricing_path):
+    # Prices in dollars per 1000 tokens, by model
+    with open(path) as f:
+        return json.load(f)
+
+
+def anthropic_api_calculate_cost(usage, model="claude-3-sonnet-20240229", batch=False):
+    pricing = load_pricing()
 
     try:
         model_pricing = pricing[model]
     except KeyError:
-        raise ValueError("Invalid model specified")
+        raise ValueError(f"Invalid model specified, add its prices to {pricing_path}")
 
-    prompt_cost = usage.input_tokens * model_pricing["prompt"] / 1000
+    # input_tokens only counts the tokens after the last cache breakpoint
+    cache_write_tokens = usage.cache_creation_input_tokens or 0
+    cache_read_tokens = usage.cache_read_input_tokens or 0
+
+    prompt_cost = (
+        usage.input_tokens
+        + cache_write_tokens * cache_write_multiplier
+        + cache_read_tokens * cache_read_multiplier
+    ) * model_pricing["prompt"] / 1000
     completion_cost = usage.output_tokens * model_pricing["completion"] / 1000
 
     total_cost = prompt_cost + completion_cost
+    if batch:
+        total_cost *= batch_discount
     # round to 6 decimals
     total_cost = round(total_cost, 6)
 
     return total_cost
 
 
-def evaluate_bertaqa(
-    config="test", model="claude-3-sonnet-20240229", shots=5, limit=1, start=0
-):
-    # Load your dataset from Hugging Face
-    print(f"Loading {config} config...")
-    dataset = load_bertaqa(config=config)
+def usage_tokens(usage):
+    return (
+        usage.input_tokens
+        + (usage.cache_creation_input_tokens or 0)
+        + (usage.cache_read_input_tokens or 0)
+        + usage.output_tokens
+    )
 
-    # Create the results directory if it doesn't exist
-    os.makedirs(f"../results/{model}", exist_ok=True)
 
-    tokens = 0
-    cost = 0
-    
+def request_kwargs(item, model):
+    return dict(
+        model=model,
+        max_tokens=1,
+        system=item["system"],
+        messages=item["messages"],
+        temperature=0,
+    )
+
+
+def cached_completion(kwargs, cache=None):
+    # Serve requests that were already sent from the local response cache.
+    # Returns the call stats of the API call, or None for a cache hit.
+    if cache is not None:
+        response = cache.get(kwargs)
+        if response is not None:
+            return Message.model_validate(response), None
+    stats = new_call_stats()
+    started = time.perf_counter()
+    try:
+        completion = completion_with_backoff(stats=stats, **kwargs)
+    finally:
+        stats["wall"] = time.perf_counter() - started
+        telemetry.record(kwargs["model"], stats)
+    return completion, stats
+
+
+async def async_cached_completion(kwargs, cache=None):
+    if cache is not None:
+        response = cache.get(kwargs)
+        if response is not None:
+            return Message.model_validate(response), None
+    stats = new_call_stats()
+    started = time.perf_counter()
+    try:
+        completion = await async_completion_with_backoff(stats=stats, **kwargs)
+    finally:
+        stats["wall"] = time.perf_counter() - started
+        telemetry.record(kwargs["model"], stats)
+    return completion, stats
+
+
+def score_completion(item, completion, model, batch=False, scoring="text"):
+    # convert completions to dict
+    response = completion.model_dump()
+
+    # Save whole response along with the original dataset fields to a jsonl file
+    item["response"] = response
+
+    if scoring == "constrained":
+        # A response without content is no answer, rather than retried
+        text = "".join(
+            block["text"] for block in response["content"] if block["type"] == "text"
+        )
+    else:
+        text = response["content"][0]["text"]
+
+    # Check if the answer is correct
+    item["prediction"] = parse_answer(text)
+    item["correct"] = item["prediction"] == answer2letter[item["answer"]]
+
+    # Calculate Anthropic API cost and add to the item
+    item["cost"] = anthropic_api_calculate_cost(completion.usage, model, batch=batch)
+    return item
+
+
+def slim_result(item):
+    # The columns kept in the parquet output, prompts are rebuilt from the
+    # few-shot indices with regenerate_messages
+    response = item["response"]
+    usage = response["usage"]
+    cache_creation_tokens = usage.get("cache_creation_input_tokens") or 0
+    cache_read_tokens = usage.get("cache_read_input_tokens") or 0
+    return {
+        "id": item["id"],
+        "position": item["position"],
+        "few_shot_indices": item["few_shot_indices"],
+        "prediction": item["prediction"],
+        "correct": item["correct"],
+        "prompt_tokens": usage["input_tokens"]
+        + cache_creation_tokens
+        + cache_read_tokens,
+        "completion_tokens": usage["output_tokens"],
+        "cached_tokens": cache_read_tokens,
+        "latency": item.get("latency"),
+        "cost": item["cost"],
+    }
+
+
+def regenerate_messages(result, sampler, cache=False):
+    # Full prompt of a result row, the same that was sent to the model. The
+    # system prompt is the same for every item.
+    messages = few_shot_messages(result["few_shot_indices"], sampler, cache=cache)
+    index = sampler.positions[result["id"]]
+    messages.append({"role": "user", "content": sampler.questions[index]})
+    return messages
+
+
+class ParquetResultWriter(evaluation.ParquetResultWriter):
+    def write(self, item):
+        self.write_row(slim_result(item))
+
+
+def build_requests(sampler, model, few_shots, completed=(), cache_prefix=False):
+    # The breakpoint after the few-shot examples also caches the system
+    # prompt before them, so it needs no breakpoint of its own
     system_prompt = "Respond always with a single letter: A, B or C."
 
-    # Iterate over your dataset and use the API
-    for i, item in enumerate(dataset):
-        if i < start:
+    requests = []
+    for i, few_shot_indices in few_shots:
+        item = dict(sampler.rows[i])
+        if item["id"] in completed:
             continue
 
-        # Get 5 random few-shot examples
-        few_shot_examples = random.sample([ex for ex in dataset if ex != item], shots)
-
         # Add the few-shot examples to the prompt
-        messages = few_shot_messages(few_shot_examples, config)
+        messages = few_shot_messages(few_shot_indices, sampler, cache=cache_prefix)
 
-        messages.append({"role": "user", "content": format_question(item, config)})
+        messages.append({"role": "user", "content": sampler.questions[i]})
 
-        # Save messages along with the original dataset fields to a jsonl file
+        # Save messages along with the original dataset fields to a jsonl file.
+        # The position keeps the dataset order of results written out of order.
+        item["position"] = i
+        item["few_shot_indices"] = few_shot_indices
         item["system"] = system_prompt
         item["messages"] = messages
+        requests.append((i, item, request_kwargs(item, model)))
+    return requests
+
 
-        while True:
+def load_dead_letters(path, model, completed=()):
+    # Requests of the items set aside by earlier runs, with the same prompts.
+    # An item set aside twice is retried once.
+    items = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                item = json.loads(line)
+                if item["id"] not in completed:
+                    for key in ["response", "error", "attempts", "cost"]:
+                        item.pop(key, None)
+                    items[item["id"]] = item
+    # Items keep the dataset position they were built with
+    return [
+        (item["position"], item, request_kwargs(item, model))
+        for item in items.values()
+    ]
+
+
+def evaluate_sync(
+    requests,
+    model,
+    writer,
+    cache=None,
+    max_cost=None,
+    dead_letters=None,
+    malformed_attempts=3,
+    scoring="text",
+    spent=0,
+):
+    tokens = 0
+    # Resumed runs start from the cost of the items already written
+    cost = spent
+
+    for i, item, kwargs in requests:
+        if max_cost is not None and cost >= max_cost:
+            print(f"Reached the ${max_cost:.2f} budget, run again with a higher one to resume")
+            break
+
+        # Responses without content are retried a few times, and paid for
+        wasted = 0
+        for _ in range(malformed_attempts):
+            started = time.perf_counter()
+            completion, stats = cached_completion(kwargs, cache)
+            latency = time.perf_counter() - started
             try:
-                completion = completion_with_backoff(
-                    model=model,
-                    max_tokens=1,
-                    system=system_prompt,
-                    messages=messages,
-                    temperature=0,
-                )
+                item = score_completion(item, completion, model, scoring=scoring)
+                break  # if no error, break the loop
+            except IndexError:
+                print(f"IndexError: {completion.model_dump()}")
+                if stats is not None:
+                    wasted += anthropic_api_calculate_cost(completion.usage, model)
+        else:
+            cost += wasted
+            write_dead_letter(
+                dead_letters, item, completion, malformed_attempts, wasted
+            )
+            continue
 
-                # convert completions to dict
-                response = completion.model_dump()
+        item["latency"] = round(latency, 3)
+        if stats is None:
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            item["telemetry"] = stats
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+        item["cost"] = round(item["cost"] + wasted, 6)
 
-                # Save whole response along with the original dataset fields to a jsonl file
-                item["response"] = response
+        cost += item["cost"]
+        tokens += usage_tokens(completion.usage)
 
-                # Check if the answer is correct
-                item["correct"] = (
-                    response["content"][0]["text"]
-                    == answer2letter[item["answer"]]
-                )
+        # Print details in a line: i, total tokens and total cost
+        print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
+
+        writer.write(item)
+
+
+async def evaluate_async(
+    requests,
+    model,
+    writer,
+    concurrency=32,
+    cache=None,
+    max_cost=None,
+    semaphore=None,
+    stop=None,
+    spent=0,
+    dead_letters=None,
+    malformed_attempts=3,
+    scoring="text",
+):
+    tokens = 0
+    # Resumed runs start from the cost of the items already written
+    cost = spent
+    # The cost of the finished requests, written or not, is added to spent,
+    # which is checked against the budget
+    # Set once stop, called with every scored item, returns True. The requests
+    # in flight are still written, no new one is sent.
+    stopped = False
+
+    # Keep at most `concurrency` requests in flight, or share the limit with
+    # other runs of the same model
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i, item, kwargs):
+        nonlocal spent, stopped
+        # Responses without content are retried a few times, and paid for
+        wasted = 0
+        for _ in range(malformed_attempts):
+            async with semaphore:
+                if stopped or (max_cost is not None and spent >= max_cost):
+                    return i, None, None
+                started = time.perf_counter()
+                try:
+                    completion, stats = await async_cached_completion(kwargs, cache)
+                except Exception as e:
+                    # Out of retries, the other requests go on without this item
+                    print(f"{i + 1}: {type(e).__name__}: {e}, left for the next run")
+                    spent += wasted
+                    return i, None, None
+                latency = time.perf_counter() - started
+            try:
+                item = score_completion(item, completion, model, scoring=scoring)
                 break  # if no error, break the loop
             except IndexError:
-                print(f"IndexError: {response}")
-                # if error, continue the loop
+                print(f"IndexError: {completion.model_dump()}")
+                if stats is not None:
+                    wasted += anthropic_api_calculate_cost(completion.usage, model)
+        else:
+            spent += wasted
+            write_dead_letter(
+                dead_letters, item, completion, malformed_attempts, wasted
+            )
+            return i, None, None
+
+        item["latency"] = round(latency, 3)
+        if stats is None:
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            item["telemetry"] = stats
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+        item["cost"] = round(item["cost"] + wasted, 6)
+        spent += item["cost"]
+        if stop is not None and not stopped and stop(item):
+            stopped = True
+        return i, item, completion.usage
 
-        # Calculate Anthropic API cost and add to the item
-        item["cost"] = anthropic_api_calculate_cost(completion.usage, model)
+    tasks = [asyncio.create_task(run(*request)) for request in requests]
+
+    # Every item is written as soon as it is scored, so a slow or failing
+    # request holds back no other. The items keep their dataset position, and
+    # the output is sorted once the run is over.
+    for task in asyncio.as_completed(tasks):
+        i, item, usage = await task
+        if item is None:
+            # Not sent because the budget ran out, or failed, left for the next
+            # run, or set aside in the dead-letter file
+            continue
 
         cost += item["cost"]
-        tokens += completion.usage.input_tokens + completion.usage.output_tokens
+        tokens += usage_tokens(usage)
 
         # Print details in a line: i, total tokens and total cost
         print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
 
-        with open(
-            f"../results/{model}/bertaqa_{config}_{shots}-shot.jsonl", "a"
-        ) as f:
-            json.dump(item, f)
-            f.write("\n")
+        writer.write(item)
 
-        if i == limit - 1:
-            break
+    if max_cost is not None and spent >= max_cost:
+        print(f"Reached the ${max_cost:.2f} budget, run again with a higher one to resume")
+
+
+async def evaluate_triage(
+    requests,
+    model,
+    writer,
+    target_halfwidth=0.03,
+    confidence=0.95,
+    min_items=30,
+    concurrency=32,
+    cache=None,
+    max_cost=None,
+    correct=(),
+    spent=0,
+    dead_letters=None,
+    malformed_attempts=3,
+    scoring="text",
+):
+    # Items are sent in a stratified random order, keeping `concurrency`
+    # requests in flight, until the confidence interval of the accuracy is
+    # narrow enough. The output file can later be completed by a full run.
+    correct = list(correct)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def narrow_enough():
+        low, high = wilson_interval(sum(correct), len(correct), z)
+        if correct:
+            print(
+                f"Accuracy {sum(correct) / len(correct):.3f} "
+                f"({low:.3f}-{high:.3f}) after {len(correct)} items"
+            )
+        if len(correct) >= min_items and (high - low) / 2 <= target_halfwidth:
+            print(f"Interval half-width below {target_halfwidth}, stopping")
+            return True
+        return False
+
+    def stop(item):
+        # Checked as every result arrives, not once per round of requests
+        correct.append(item["correct"])
+        return narrow_enough()
+
+    # An earlier run may have already narrowed the interval enough
+    if narrow_enough():
+        return
+    await evaluate_async(
+        stratified_order(requests),
+        model,
+        writer,
+        concurrency=concurrency,
+        cache=cache,
+        max_cost=max_cost,
+        spent=spent,
+        dead_letters=dead_letters,
+        malformed_attempts=malformed_attempts,
+        scoring=scoring,
+        stop=stop,
+    )
+
+
+def evaluate_batch(
+    requests,
+    model,
+    writer,
+    batch_client,
+    batch_dir,
+    batch_id=None,
+    poll_interval=60,
+    cache=None,
+    dead_letters=None,
+    scoring="text",
+):
+    # Only the requests missing from the response cache go into the batch
+    hits = {}
+    if cache is not None:
+        for i, item, kwargs in requests:
+            response = cache.get(kwargs)
+            if response is not None:
+                hits[i] = response
+    misses = [request for request in requests if request[0] not in hits]
+
+    results = {}
+    if batch_id is not None or misses:
+        results = run_batch(
+            misses,
+            model,
+            writer,
+            batch_client,
+            batch_dir,
+            batch_id=batch_id,
+            poll_interval=poll_interval,
+        )
+
+    tokens = 0
+    cost = 0
+
+    # Join the batch results back to the items in dataset order
+    for i, item, kwargs in requests:
+        if i in hits:
+            completion = Message.model_validate(hits[i])
+            item = score_completion(item, completion, model, scoring=scoring)
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            result = results.get(str(i))
+            if result is None or result.type != "succeeded":
+                print(f"{i + 1}: no result in batch, skipping")
+                continue
+
+            completion = result.message
+            try:
+                item = score_completion(
+                    item, completion, model, batch=True, scoring=scoring
+                )
+            except IndexError:
+                print(f"IndexError: {completion.model_dump()}")
+                wasted = anthropic_api_calculate_cost(
+                    completion.usage, model, batch=True
+                )
+                write_dead_letter(dead_letters, item, completion, 1, wasted)
+                cost += wasted
+                continue
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+
+        cost += item["cost"]
+        tokens += usage_tokens(completion.usage)
+
+        # Print details in a line: i, total tokens and total cost
+        print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
+
+        writer.write(item)
+    return cost
+
+
+def run_batch(
+    requests, model, writer, batch_client, batch_dir, batch_id=None, poll_interval=60
+):
+    if batch_id is None:
+        # Write the same request params as the other modes to a batch input file
+        os.makedirs(batch_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(writer.path))[0] + "_batch_input.jsonl"
+        input_path = os.path.join(batch_dir, name)
+        with open(input_path, "w") as f:
+            for i, item, kwargs in requests:
+                request = {"custom_id": str(i), "params": kwargs}
+                json.dump(request, f)
+                f.write("\n")
+
+        with open(input_path) as f:
+            batch_requests = [json.loads(line) for line in f]
+        batch = batch_client.messages.batches.create(requests=batch_requests)
+        print(f"Submitted batch {batch.id} with {len(requests)} requests")
+    else:
+        batch = batch_client.messages.batches.retrieve(batch_id)
+
+    while batch.processing_status != "ended":
+        print(
+            f"Batch {batch.id} is {batch.processing_status}, checking again in {poll_interval}s"
+        )
+        time.sleep(poll_interval)
+        batch = batch_client.messages.batches.retrieve(batch.id)
+
+    results = {}
+    for result in batch_client.messages.batches.results(batch.id):
+        results[result.custom_id] = result.result
+    return results
+
+
+def content_text(content):
+    # Content is either a string or a list of text blocks
+    if isinstance(content, str):
+        return content
+    return "".join(block["text"] for block in content)
+
+
+def count_tokens(kwargs, encoding):
+    # Every message adds a few formatting tokens to its content
+    tokens = len(encoding.encode(content_text(kwargs["system"])))
+    for message in kwargs["messages"]:
+        tokens += 3 + len(encoding.encode(content_text(message["content"])))
+    return tokens
+
+
+def plan_run(
+    requests, model, concurrency=32, rpm=None, tpm=None, request_latency=1.0
+):
+    # tiktoken is only needed to plan runs. The Claude 3 tokenizer is not
+    # public, so cl100k_base is used as an approximation.
+    import tiktoken
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+
+    prompt_tokens = sum(count_tokens(kwargs, encoding) for _, _, kwargs in requests)
+    completion_tokens = sum(kwargs["max_tokens"] for _, _, kwargs in requests)
+    usage = Usage(input_tokens=prompt_tokens, output_tokens=completion_tokens)
+    cost = anthropic_api_calculate_cost(usage, model)
+    batch_cost = anthropic_api_calculate_cost(usage, model, batch=True)
+
+    print_plan(
+        len(requests),
+        prompt_tokens,
+        completion_tokens,
+        cost,
+        batch_cost,
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        request_latency=request_latency,
+    )
+    return cost
+
+
+def evaluate_bertaqa(
+    config="test",
+    model="claude-3-sonnet-20240229",
+    shots=5,
+    limit=None,
+    start=0,
+    mode="sync",
+    concurrency=32,
+    batch_endpoint="anthropic",
+    batch_id=None,
+    poll_interval=60,
+    shot_buckets=0,
+    cache="off",
+    cache_path="../results/responses.sqlite",
+    cache_max_mb=1024,
+    rpm=None,
+    tpm=None,
+    max_cost=None,
+    request_latency=1.0,
+    output_format="jsonl",
+    target_halfwidth=0.03,
+    confidence=0.95,
+    metrics_path=None,
+    dataset_path=None,
+    num_shards=1,
+    shard_id=0,
+    quota_share=None,
+    malformed_attempts=3,
+    retry_dead_letters=False,
+    scoring="text",
+):
+    # Triage picks its own sample and merge checks every item, so both cover
+    # the whole range unless told otherwise
+    if limit is None:
+        limit = 0 if mode in ["triage", "merge"] else 1
+
+    # Load your dataset from Hugging Face
+    print(f"Loading {config} config...")
+    dataset = load_bertaqa(config=config, path=dataset_path)
+
+    # Create the results directory if it doesn't exist
+    os.makedirs(f"../results/{model}", exist_ok=True)
+    path = f"../results/{model}/bertaqa_{config}_{shots}-shot.{output_format}"
+
+    if mode == "merge":
+        merge_shards(
+            path,
+            dataset["id"],
+            num_shards,
+            start=start,
+            limit=limit,
+            output_format=output_format,
+            parquet_writer=ParquetResultWriter,
+        )
+        return
+
+    # Every shard writes its own file, joined afterwards with --mode merge
+    if num_shards > 1:
+        path = shard_path(path, num_shards, shard_id)
+    # Shards on the same key split its quota evenly unless told otherwise
+    if quota_share is None:
+        quota_share = 1 / num_shards
+
+    # Items already in the output file are skipped, so a crashed run can be resumed
+    if output_format == "jsonl":
+        completed = load_completed_ids(path)
+    elif output_format == "parquet":
+        completed = load_completed_parquet_ids(path)
+    else:
+        raise ValueError("output_format must be 'jsonl' or 'parquet'")
+    if scoring not in ["text", "constrained"]:
+        raise ValueError("scoring must be 'text' or 'constrained'")
+    if completed:
+        print(f"Resuming, {len(completed)} items already in {path}")
+
+    # Items whose responses keep coming back without content are set aside
+    dead_letter_path = os.path.splitext(path)[0] + "_dead_letters.jsonl"
+
+    if retry_dead_letters:
+        requests = load_dead_letters(dead_letter_path, model, completed=completed)
+        print(f"Retrying {len(requests)} items from {dead_letter_path}")
+    else:
+        # Build every prompt up front, each item gets the same few-shot
+        # examples in every mode
+        sampler = FewShotSampler(
+            dataset, config=config, shots=shots, buckets=shot_buckets
+        )
+        few_shots = draw_few_shots(
+            sampler,
+            start=start,
+            limit=limit,
+            num_shards=num_shards,
+            shard_id=shard_id,
+        )
+        # Fixed few-shot sets share a prefix, mark it with a cache breakpoint
+        if shot_buckets > 0:
+            check_cache_prefix(sampler, cache_minimum(model))
+        requests = build_requests(
+            sampler,
+            model,
+            few_shots,
+            completed=completed,
+            cache_prefix=shot_buckets > 0,
+        )
+
+    if mode == "plan":
+        plan_run(
+            requests,
+            model,
+            concurrency=concurrency,
+            rpm=rpm * quota_share if rpm else rpm,
+            tpm=tpm * quota_share if tpm else tpm,
+            request_latency=request_latency,
+        )
+        return
+
+    # Requests are paced to the model's quota, learned from the response
+    # headers when it is not given
+    get_rate_limiter(model, rpm=rpm, tpm=tpm, share=quota_share)
+
+    # Latency, retries and throughput of the calls, exported while running
+    telemetry.path = metrics_path
+
+    if cache == "off":
+        response_cache = None
+    elif cache in ["on", "replay"]:
+        response_cache = ResponseCache(
+            cache_path,
+            max_bytes=cache_max_mb * 2**20,
+            read_only=cache == "replay",
+        )
+    else:
+        raise ValueError("cache must be 'off', 'on' or 'replay'")
+
+    if output_format == "parquet":
+        writer = ParquetResultWriter(path)
+    else:
+        writer = ResultWriter(path)
+
+    # A retry rewrites the dead-letter file with the items that still fail, the
+    # old one is kept until the retry is over
+    if retry_dead_letters:
+        dead_letters = ResultWriter(dead_letter_path + ".tmp", truncate=True)
+    else:
+        dead_letters = ResultWriter(dead_letter_path)
+
+    # Items already paid for count against the budget of a resumed run
+    spent = load_spent(path)
+
+    with writer, dead_letters:
+        if mode == "sync":
+            evaluate_sync(
+                requests,
+                model,
+                writer,
+                cache=response_cache,
+                max_cost=max_cost,
+                spent=spent,
+                dead_letters=dead_letters,
+                malformed_attempts=malformed_attempts,
+                scoring=scoring,
+            )
+        elif mode == "async":
+            asyncio.run(
+                evaluate_async(
+                    requests,
+                    model,
+                    writer,
+                    concurrency=concurrency,
+                    cache=response_cache,
+                    max_cost=max_cost,
+                    spent=spent,
+                    dead_letters=dead_letters,
+                    malformed_attempts=malformed_attempts,
+                    scoring=scoring,
+                )
+            )
+        elif mode == "triage":
+            asyncio.run(
+                evaluate_triage(
+                    requests,
+                    model,
+                    writer,
+                    target_halfwidth=target_halfwidth,
+                    confidence=confidence,
+                    concurrency=concurrency,
+                    cache=response_cache,
+                    max_cost=max_cost,
+                    spent=spent,
+                    correct=load_correct(path),
+                    dead_letters=dead_letters,
+                    malformed_attempts=malformed_attempts,
+                    scoring=scoring,
+                )
+            )
+        elif mode == "batch":
+            if max_cost is not None:
+                raise ValueError("max_cost is not supported in batch mode")
+            batch_dir = f"../results/{model}/batches"
+            if batch_endpoint == "anthropic":
+                batch_client = client
+            elif batch_endpoint == "local":
+                batch_client = LocalBatchClient(os.path.join(batch_dir, "local"))
+            else:
+                raise ValueError("batch_endpoint must be 'anthropic' or 'local'")
+            evaluate_batch(
+                requests,
+                model,
+                writer,
+                batch_client,
+                batch_dir,
+                batch_id=batch_id,
+                poll_interval=poll_interval,
+                cache=response_cache,
+                dead_letters=dead_letters,
+                scoring=scoring,
+            )
+        else:
+            raise ValueError(
+                "mode must be 'sync', 'async', 'triage', 'batch', 'plan' or 'merge'"
+            )
+
+    if retry_dead_letters:
+        # Items the retry never sent, because the budget ran out, the triage
+        # stopped or the request failed, keep their record and cost
+        if output_format == "parquet":
+            done = load_completed_parquet_ids(path)
+        else:
+            done = load_completed_ids(path)
+        done |= load_completed_ids(dead_letters.path)
+        with ResultWriter(dead_letters.path) as kept:
+            for item in read_results(dead_letter_path):
+                if item["id"] not in done:
+                    done.add(item["id"])
+                    kept.write(item)
+        os.replace(dead_letters.path, dead_letter_path)
+    if os.path.getsize(dead_letter_path) == 0:
+        os.remove(dead_letter_path)
+    elif not retry_dead_letters:
+        print("Some items were set aside, retry them with --retry_dead_letters")
+
+    # Async runs write the items as they are scored, and retried items come
+    # after the others
+    if mode in ["async", "triage"] or retry_dead_letters:
+        sort_results(
+            path, dataset["id"], output_format, parquet_writer=ParquetResultWriter
+        )
+
+    telemetry.summary()
+
+    if response_cache is not None:
+        response_cache.close()
 
 
 def main():
@@ -175,14 +980,205 @@ def main():
         "--shots", type=int, default=5, help="Number of few-shot examples"
     )
     parser.add_argument(
-        "--limit", type=int, default=1, help="Number of examples to evaluate"
+        "--limit",
+        type=int,
+        default=None,
+        help="Number of examples to evaluate, 0 for all the examples from --start. "
+        "By default 0 in triage and merge modes and 1 otherwise",
     )
     parser.add_argument(
         "--start", type=int, default=0, help="Start index of the examples to evaluate"
     )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="sync",
+        choices=["sync", "async", "triage", "batch", "plan", "merge"],
+        help="Send one request at a time (sync), many concurrently (async) "
+        "or all of them through the Message Batches API (batch)."
+        " The plan mode only projects the tokens, cost and runtime of the run,"
+        " and the triage mode stops once the accuracy is known well enough."
+        " The merge mode joins the files of the shards into one",
+    )
+    parser.add_argument(
+        "--target_halfwidth",
+        type=float,
+        default=0.03,
+        help="Half-width of the accuracy confidence interval at which the triage "
+        "mode stops",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the interval in triage mode",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Maximum number of requests in flight in async mode",
+    )
+    parser.add_argument(
+        "--batch_endpoint",
+        type=str,
+        default="anthropic",
+        choices=["anthropic", "local"],
+        help="Submit batches to the Anthropic Message Batches API or to a local file-based stand-in",
+    )
+    parser.add_argument(
+        "--batch_id",
+        type=str,
+        default=None,
+        help="Resume polling an already submitted batch instead of creating a new one",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=int,
+        default=60,
+        help="Seconds between batch status checks",
+    )
+    parser.add_argument(
+        "--shot_buckets",
+        type=int,
+        default=0,
+        help="Number of fixed few-shot sets shared across items, so requests reuse "
+        "a cached prompt prefix. 0 draws new few-shot examples for every item",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default="off",
+        choices=["off", "on", "replay"],
+        help="Serve repeated requests from a local response cache (on), "
+        "or only from the cache without calling the API (replay)",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="../results/responses.sqlite",
+        help="SQLite file of the response cache",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=int,
+        default=1024,
+        help="Size of the response cache, least recently used responses are evicted above it",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Requests per minute allowed for the model, by default read from the rate limit headers",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="Tokens per minute allowed for the model, by default read from the rate limit headers",
+    )
+    parser.add_argument(
+        "--max_cost",
+        type=float,
+        default=None,
+        help="Stop the run once it has cost this many dollars, it can be resumed later",
+    )
+    parser.add_argument(
+        "--request_latency",
+        type=float,
+        default=1.0,
+        help="Seconds per request assumed by the plan mode to project the runtime",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="jsonl",
+        choices=["jsonl", "parquet"],
+        help="Save the full items as jsonl, or only the id, few-shot indices, "
+        "prediction, usage, latency and cost as a parquet dataset",
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help="Prometheus text file with the latency, retry and throughput metrics, "
+        "updated during the run",
+    )
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="Local jsonl file with the items of the config, instead of the Hub",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the examples in this many shards, each run as its own process "
+        "and written to its own file",
+    )
+    parser.add_argument(
+        "--shard_id", type=int, default=0, help="Shard to evaluate, from 0"
+    )
+    parser.add_argument(
+        "--quota_share",
+        type=float,
+        default=None,
+        help="Fraction of the model's rate limits used by this shard, 1/num_shards "
+        "by default. Use 1 when every shard has its own API key",
+    )
+    parser.add_argument(
+        "--scoring",
+        type=str,
+        default="text",
+        choices=["text", "constrained"],
+        help="Retry responses without content (text), or score them as no answer "
+        "so that no request is sent twice (constrained). Both parse the answer "
+        "into the prediction field",
+    )
+    parser.add_argument(
+        "--malformed_attempts",
+        type=int,
+        default=3,
+        help="Attempts for an item whose response has no content, before it is "
+        "set aside in the dead-letter file",
+    )
+    parser.add_argument(
+        "--retry_dead_letters",
+        action="store_true",
+        help="Only retry the items in the dead-letter file of the run",
+    )
     args = parser.parse_args()
     evaluate_bertaqa(
-        config=args.config, model=args.model, shots=args.shots, limit=args.limit, start=args.start
+        config=args.config,
+        model=args.model,
+        shots=args.shots,
+        limit=args.limit,
+        start=args.start,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        batch_endpoint=args.batch_endpoint,
+        batch_id=args.batch_id,
+        poll_interval=args.poll_interval,
+        shot_buckets=args.shot_buckets,
+        cache=args.cache,
+        cache_path=args.cache_path,
+        cache_max_mb=args.cache_max_mb,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        max_cost=args.max_cost,
+        request_latency=args.request_latency,
+        output_format=args.output_format,
+        target_halfwidth=args.target_halfwidth,
+        confidence=args.confidence,
+        metrics_path=args.metrics_path,
+        dataset_path=args.dataset_path,
+        num_shards=args.num_shards,
+        shard_id=args.shard_id,
+        quota_share=args.quota_share,
+        malformed_attempts=args.malformed_attempts,
+        retry_dead_letters=args.retry_dead_letters,
+        scoring=args.scoring,
     )
 
 
@@ -0,0 +1,121 @@
+import json
+import os
+import uuid
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+from anthropic.types.messages import MessageBatch, MessageBatchIndividualResponse
+
+
+def answer_a(params):
+    return "A"
+
+
+def text_length(content):
+    # Content is either a string or a list of text blocks
+    if isinstance(content, str):
+        return len(content)
+    return sum(len(block["text"]) for block in content)
+
+
+class LocalMessageBatches:
+    def __init__(self, root, respond):
+        self.root = root
+        self.respond = respond
+
+    def path(self, batch_id, kind):
+        return os.path.join(self.root, f"{batch_id}_{kind}.jsonl")
+
+    def save(self, batch):
+        with open(os.path.join(self.root, f"{batch.id}.json"), "w") as f:
+            f.write(batch.model_dump_json())
+        return batch
+
+    def create(self, requests):
+        now = datetime.now(timezone.utc)
+        batch = MessageBatch(
+            id=f"msgbatch_{uuid.uuid4().hex}",
+            created_at=now,
+            expires_at=now + timedelta(hours=24),
+            processing_status="in_progress",
+            request_counts={
+                "canceled": 0,
+                "errored": 0,
+                "expired": 0,
+                "processing": len(requests),
+                "succeeded": 0,
+            },
+            type="message_batch",
+        )
+        with open(self.path(batch.id, "requests"), "w") as f:
+            for request in requests:
+                json.dump(request, f)
+                f.write("\n")
+        return self.save(batch)
+
+    def retrieve(self, batch_id):
+        with open(os.path.join(self.root, f"{batch_id}.json")) as f:
+            batch = MessageBatch.model_validate_json(f.read())
+        if batch.processing_status == "in_progress":
+            batch = self.run(batch)
+        return self.save(batch)
+
+    def run(self, batch):
+        results = []
+        with open(self.path(batch.id, "requests")) as f:
+            for line in f:
+                request = json.loads(line)
+                params = request["params"]
+                # Rough token counts, enough to exercise the cost accounting
+                input_tokens = (
+                    text_length(params.get("system", ""))
+                    + sum(text_length(m["content"]) for m in params["messages"])
+                ) // 4
+                # A respond that returns None gives a response without content
+                text = self.respond(params)
+                message = {
+                    "id": f"msg_{uuid.uuid4().hex}",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": params["model"],
+                    "content": [] if text is None else [{"type": "text", "text": text}],
+                    "stop_reason": "max_tokens",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+                }
+                results.append(
+                    {
+                        "custom_id": request["custom_id"],
+                        "result": {"type": "succeeded", "message": message},
+                    }
+                )
+        with open(self.path(batch.id, "results"), "w") as f:
+            for result in results:
+                json.dump(result, f)
+                f.write("\n")
+        batch.processing_status = "ended"
+        batch.ended_at = datetime.now(timezone.utc)
+        batch.request_counts.processing = 0
+        batch.request_counts.succeeded = len(results)
+        return batch
+
+    def results(self, batch_id):
+        with open(self.path(batch_id, "results")) as f:
+            for line in f:
+                yield MessageBatchIndividualResponse.model_validate_json(line)
+
+
+class LocalBatchClient:
+    """
+    File-based stand-in for the Anthropic Message Batches endpoint.
+
+    Batches are stored as json files under `root` and answered by `respond`,
+    which maps the request params to the text of the assistant message, or to
+    None for a message without content. This lets the submit, poll and join
+    path of the batch mode run without network access.
+    """
+
+    def __init__(self, root, respond=answer_a):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.messages = SimpleNamespace(batches=LocalMessageBatches(root, respond))
@@ -0,0 +1,807 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import time
+from collections import Counter
+
+from datasets import load_dataset
+from tenacity import wait_random_exponential
+
+# Dataset, prompts, rate limiting, telemetry and outputs, shared by the
+# evaluators of every provider
+
+wait_exponential = wait_random_exponential(min=1, max=60)
+
+seed = 42
+
+answer2letter = {0: "A", 1: "B", 2: "C"}
+
+
+def load_bertaqa(config="eu", path=None):
+    if path is not None:
+        # A local jsonl copy of the test split, e.g. to run without network
+        return load_dataset("json", data_files=path, split="train")
+    dataset = load_dataset("HiTZ/bertaqa", name=config, split="test")
+    return dataset
+
+
+def format_question(item, config="eu"):
+    question = item["question"]
+    candidates = item["candidates"]
+
+    # Format the question with the given prompt
+    if config == "eu":
+        formatted_question = f"Galdera: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nErantzuna:"
+    elif config in ["en", "en_mt"]:
+        formatted_question = f"Question: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nAnswer:"
+    else:
+        raise ValueError("config must be 'eu', 'en' or 'en_mt'")
+    return formatted_question
+
+
+def item_rng(seed, config, key):
+    # Every item draws from its own generator, seeded from a hash of the seed,
+    # config and item id, so its draws don't depend on the items before it
+    digest = hashlib.sha256(f"{seed}:{config}:{key}".encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+class FewShotSampler:
+    def __init__(self, dataset, config="eu", shots=5, buckets=0, seed=seed):
+        self.rows = dataset.to_list()
+        self.config = config
+        self.shots = shots
+        self.buckets = buckets
+        self.seed = seed
+        # Format every example once, prompts only index into these lists
+        self.questions = [format_question(row, config) for row in self.rows]
+        self.letters = [answer2letter[row["answer"]] for row in self.rows]
+        self.positions = {row["id"]: i for i, row in enumerate(self.rows)}
+
+        # With buckets, items share a few fixed few-shot sets so that requests
+        # start with the same prefix. The extra last set is used by the items
+        # that are part of their own bucket's set.
+        if buckets:
+            rng = item_rng(seed, config, f"buckets-{buckets}")
+            indices = rng.sample(range(len(self.rows)), (buckets + 1) * shots)
+            self.fixed = [
+                indices[b * shots : (b + 1) * shots] for b in range(buckets + 1)
+            ]
+
+    def sample(self, index):
+        if self.buckets:
+            few_shot_indices = self.fixed[index % self.buckets]
+            if index in few_shot_indices:
+                few_shot_indices = self.fixed[-1]
+            return list(few_shot_indices)
+
+        # Sample from every row but the target without building a filtered
+        # copy: draw from n - 1 positions and skip over the target index
+        rng = item_rng(self.seed, self.config, self.rows[index]["id"])
+        indices = rng.sample(range(len(self.rows) - 1), self.shots)
+        return [j + 1 if j >= index else j for j in indices]
+
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None, share=1.0):
+        # Limits left as None are unknown until the first response headers.
+        # Only `share` of the quota is used, the rest is left to the other
+        # shards running on the same key.
+        self.share = share
+        self.rpm = rpm * share if rpm is not None else None
+        self.tpm = tpm * share if tpm is not None else None
+        self.requests = self.rpm
+        self.tokens = self.tpm
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm is not None:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm is not None:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def reserve(self, tokens):
+        # Take one request and `tokens` tokens from the buckets, or return how
+        # long to wait until they are available
+        self.refill()
+        delay = self.blocked_until - time.monotonic()
+        if self.rpm is not None and self.requests < 1:
+            delay = max(delay, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm is not None:
+            tokens = min(tokens, self.tpm)
+            if self.tokens < tokens:
+                delay = max(delay, (tokens - self.tokens) * 60 / self.tpm)
+        if delay > 0:
+            return delay
+        if self.rpm is not None:
+            self.requests -= 1
+        if self.tpm is not None:
+            self.tokens -= tokens
+        return 0
+
+    def acquire(self, tokens):
+        while (delay := self.reserve(tokens)) > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens):
+        while (delay := self.reserve(tokens)) > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, estimated, used):
+        # Charge the difference between the estimate and the actual usage
+        if self.tpm is not None:
+            self.tokens -= used - estimated
+
+    def update(self, limits):
+        # The provider's view of the quota wins over the local estimate
+        self.refill()
+        for kind, limit in [("requests", "rpm"), ("tokens", "tpm")]:
+            if limits.get(f"limit_{kind}") is not None:
+                setattr(self, limit, limits[f"limit_{kind}"] * self.share)
+                if getattr(self, kind) is None:
+                    setattr(self, kind, getattr(self, limit))
+            remaining = limits.get(f"remaining_{kind}")
+            if remaining is not None and getattr(self, limit) is not None:
+                remaining *= self.share
+                setattr(self, kind, min(getattr(self, kind), remaining))
+                if remaining == 0 and limits.get(f"reset_{kind}") is not None:
+                    self.pause(limits[f"reset_{kind}"])
+
+    def pause(self, seconds):
+        # Stop every request to this model, not just the one that failed
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+rate_limiters = {}
+
+
+def get_rate_limiter(model, rpm=None, tpm=None, share=1.0):
+    if model not in rate_limiters:
+        rate_limiters[model] = RateLimiter(rpm=rpm, tpm=tpm, share=share)
+    return rate_limiters[model]
+
+
+def estimate_tokens(kwargs):
+    # Roughly 4 characters per token, plus the completion tokens
+    text = json.dumps(kwargs.get("system", "")) + json.dumps(kwargs["messages"])
+    return len(text) // 4 + kwargs.get("max_tokens", 1)
+
+
+def wait_for_rate_limit(retry_state):
+    # On a 429, wait as long as the provider asks and make every request to the
+    # same model wait with it. Other errors back off exponentially.
+    exception = retry_state.outcome.exception()
+    response = getattr(exception, "response", None)
+    if response is not None and response.headers.get("retry-after"):
+        delay = float(response.headers["retry-after"])
+    else:
+        delay = wait_exponential(retry_state)
+    if getattr(exception, "status_code", None) == 429:
+        model = retry_state.kwargs.get("model")
+        get_rate_limiter(model).pause(delay)
+    stats = retry_state.kwargs.get("stats")
+    if stats is not None:
+        stats["status"] = getattr(exception, "status_code", None)
+        stats["retries"] += 1
+        stats["backoff"] += delay
+    return delay
+
+
+def new_call_stats():
+    # Filled in by completion_with_backoff and wait_for_rate_limit
+    return {
+        "status": None,
+        "retries": 0,
+        "backoff": 0.0,
+        "throttle": 0.0,
+        "wall": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+    }
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of sorted values
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class Telemetry:
+    # Upper bounds of the latency histogram buckets, in seconds
+    buckets = [0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+    quantiles = [0.5, 0.95, 0.99]
+
+    def __init__(self, path=None, interval=10):
+        self.path = path
+        self.interval = interval
+        self.calls = {}
+        self.started = {}
+        self.written = 0.0
+
+    def record(self, model, stats):
+        if model not in self.calls:
+            self.calls[model] = []
+            self.started[model] = time.monotonic() - stats["wall"]
+        self.calls[model].append(stats)
+        # Keep the metrics file fresh for scrapers while the run goes on
+        if self.path is not None and time.monotonic() - self.written >= self.interval:
+            self.write()
+
+    def throughput(self, model):
+        # Calls and tokens per second since the first call to the model
+        calls = self.calls[model]
+        elapsed = max(time.monotonic() - self.started[model], 1e-9)
+        tokens = sum(s["prompt_tokens"] + s["completion_tokens"] for s in calls)
+        return len(calls) / elapsed, tokens / elapsed
+
+    def prometheus(self):
+        # Text exposition format, with one series per model
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append(f"# HELP bertaqa_{name} {help}")
+            lines.append(f"# TYPE bertaqa_{name} {kind}")
+            for suffix, labels, value in samples:
+                labels = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                lines.append(f"bertaqa_{name}{suffix}{{{labels}}} {value}")
+
+        histogram, quantiles, statuses = [], [], []
+        for model, calls in self.calls.items():
+            walls = sorted(s["wall"] for s in calls)
+            for bucket in self.buckets + ["+Inf"]:
+                count = sum(1 for wall in walls if bucket == "+Inf" or wall <= bucket)
+                histogram.append(("_bucket", {"model": model, "le": bucket}, count))
+            histogram.append(("_sum", {"model": model}, sum(walls)))
+            histogram.append(("_count", {"model": model}, len(walls)))
+            for q in self.quantiles:
+                labels = {"model": model, "quantile": q}
+                quantiles.append(("", labels, percentile(walls, q)))
+            for status, count in Counter(s["status"] for s in calls).items():
+                statuses.append(("", {"model": model, "status": status}, count))
+
+        add(
+            "request_duration_seconds",
+            "histogram",
+            "Wall time of API calls, retries included",
+            histogram,
+        )
+        add(
+            "request_duration_quantile_seconds",
+            "gauge",
+            "Latency percentiles of API calls",
+            quantiles,
+        )
+        add("requests_total", "counter", "API calls by final HTTP status", statuses)
+        for name, help, key in [
+            ("retries_total", "Retried API calls", "retries"),
+            ("backoff_seconds_total", "Time waiting between retries", "backoff"),
+            ("throttle_seconds_total", "Time waiting for the rate limiter", "throttle"),
+            ("prompt_tokens_total", "Prompt tokens used", "prompt_tokens"),
+            ("completion_tokens_total", "Completion tokens used", "completion_tokens"),
+        ]:
+            samples = [
+                ("", {"model": model}, sum(s[key] for s in calls))
+                for model, calls in self.calls.items()
+            ]
+            add(name, "counter", help, samples)
+        add(
+            "requests_per_second",
+            "gauge",
+            "API calls per second since the first call",
+            [("", {"model": model}, self.throughput(model)[0]) for model in self.calls],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Replace the file in one step, so it is never read half written
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, self.path)
+        self.written = time.monotonic()
+
+    def summary(self):
+        if self.path is not None:
+            self.write()
+        for model, calls in self.calls.items():
+            walls = sorted(s["wall"] for s in calls)
+            statuses = Counter(s["status"] for s in calls)
+            calls_per_second, tokens_per_second = self.throughput(model)
+            print(
+                f"** Telemetry: {model} **\n"
+                f"Calls: {len(calls):,} ({calls_per_second:.2f}/s, "
+                f"{tokens_per_second:,.0f} tokens/s)\n"
+                f"Latency: p50 {percentile(walls, 0.5):.2f}s, "
+                f"p95 {percentile(walls, 0.95):.2f}s, "
+                f"p99 {percentile(walls, 0.99):.2f}s\n"
+                f"Retries: {sum(s['retries'] for s in calls)}, "
+                f"{sum(s['backoff'] for s in calls):.1f}s in backoff, "
+                f"{sum(s['throttle'] for s in calls):.1f}s throttled\n"
+                f"Statuses: "
+                + ", ".join(f"{status}: {count}" for status, count in statuses.items())
+                + "\n"
+            )
+
+
+def parse_answer(text):
+    # Both providers' answers are reduced to a letter, surrounding whitespace
+    # is ignored and anything else is no answer
+    text = text.strip()
+    return text if text in answer2letter.values() else None
+
+
+def shard_range(n_rows, start=0, limit=1, num_shards=1, shard_id=0):
+    # The `limit` items from `start`, or all the rest with a limit of 0, split
+    # with a stride so every shard gets a mix of groups and categories
+    if not 0 <= shard_id < num_shards:
+        raise ValueError("shard_id must be between 0 and num_shards - 1")
+    end = n_rows if limit == 0 else min(n_rows, start + limit)
+    return range(start + shard_id, end, num_shards)
+
+
+def shard_path(path, num_shards, shard_id):
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard-{shard_id:02d}-of-{num_shards:02d}{ext}"
+
+
+def check_cache_prefix(sampler, minimum):
+    # Providers only cache prefixes above a minimum length, and five BertaQA
+    # examples are a few hundred tokens. Estimate the shortest few-shot set
+    # at about 4 characters per token and warn when it falls short.
+    lengths = [
+        sum(len(sampler.questions[j]) + len(sampler.letters[j]) for j in indices) // 4
+        for indices in sampler.fixed
+    ]
+    shortest = min(lengths)
+    if shortest < minimum:
+        per_shot = sum(lengths) / (len(lengths) * sampler.shots)
+        needed = math.ceil(minimum / per_shot)
+        print(
+            f"Warning: the few-shot prefix is about {shortest} tokens, below the "
+            f"{minimum} tokens needed for prompt caching. Use --shots {needed} or "
+            "more for --shot_buckets to pay off"
+        )
+    return shortest
+
+
+def draw_few_shots(sampler, start=0, limit=1, num_shards=1, shard_id=0):
+    # The few-shot examples only depend on the item, so items get the same
+    # prompts as in an uninterrupted run whatever the start, limit, shard or
+    # the items already completed
+    indices = shard_range(len(sampler.rows), start, limit, num_shards, shard_id)
+    return [(i, sampler.sample(i)) for i in indices]
+
+
+def stratified_order(requests, seed=seed):
+    # Shuffle the items of every group, category and difficulty and spread
+    # them evenly over the run, so any prefix is close to a stratified sample
+    rng = random.Random(seed)
+    strata = {}
+    for request in requests:
+        item = request[1]
+        key = (item["group"], item["category"], item["difficulty"])
+        strata.setdefault(key, []).append(request)
+
+    positions = []
+    for members in strata.values():
+        rng.shuffle(members)
+        offset = rng.random()
+        for k, request in enumerate(members):
+            positions.append(((k + offset) / len(members), request))
+    positions.sort(key=lambda position: position[0])
+    return [request for _, request in positions]
+
+
+def wilson_interval(successes, n, z=1.96):
+    # Confidence interval of a proportion, also sound for small samples
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    return center - margin, center + margin
+
+
+def load_column(path, column):
+    # One field of every item already in the output file
+    if os.path.isdir(path):
+        import pyarrow.parquet as pq
+
+        if not any(name.endswith(".parquet") for name in os.listdir(path)):
+            return []
+        return pq.read_table(path, columns=[column]).column(column).to_pylist()
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line)[column] for line in f]
+
+
+def load_correct(path):
+    # Correctness of the items already in the output file
+    return load_column(path, "correct")
+
+
+def load_spent(path):
+    # Cost of the items already in the output file, so that a budget holds
+    # across resumed runs
+    return sum(load_column(path, "cost"))
+
+
+def load_completed_ids(path):
+    # Collect the ids already written by a previous run of the same output file
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                item = None
+            if item is None or not line.endswith(b"\n"):
+                # Only the last line can be cut short by a crash
+                if f.read(1):
+                    raise ValueError(f"Malformed line in {path} at byte {end}")
+                break
+            completed.add(item["id"])
+            end += len(line)
+
+    if end < os.path.getsize(path):
+        print(f"Dropping incomplete last line of {path}")
+        with open(path, "r+b") as f:
+            f.truncate(end)
+    return completed
+
+
+class ResultWriter:
+    def __init__(self, path, sync_every=20, truncate=False):
+        self.path = path
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.f = open(path, "w" if truncate else "a")
+
+    def write(self, item):
+        json.dump(item, self.f)
+        self.f.write("\n")
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        # Make sure written items survive a crash, so they are never paid twice
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_dead_letter(
+    dead_letters,
+    item,
+    completion,
+    attempts,
+    cost,
+    error="IndexError: response without content",
+):
+    # Items whose responses keep coming back malformed are set aside with
+    # their prompt, to be retried later
+    print(f"{item['id']}: {error} after {attempts} attempts, set aside")
+    if dead_letters is None:
+        return
+    item = dict(item)
+    item["response"] = completion.model_dump()
+    item["error"] = error
+    item["attempts"] = attempts
+    item["cost"] = round(cost, 6)
+    dead_letters.write(item)
+
+
+def load_completed_parquet_ids(path):
+    # pyarrow is only needed for the parquet output
+    import pyarrow.parquet as pq
+
+    if not os.path.isdir(path) or not any(
+        name.endswith(".parquet") for name in os.listdir(path)
+    ):
+        return set()
+    return set(pq.read_table(path, columns=["id"]).column("id").to_pylist())
+
+
+class ParquetResultWriter:
+    def __init__(self, path, sync_every=100):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        self.path = path
+        self.sync_every = sync_every
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        self.parts = sum(name.endswith(".parquet") for name in os.listdir(path))
+        self.schema = pa.schema(self.fields(pa))
+
+    def fields(self, pa):
+        # Columns of every evaluator, which adds its own and writes the rows
+        # of its results with write
+        return [
+            ("id", pa.int64()),
+            ("position", pa.int64()),
+            ("few_shot_indices", pa.list_(pa.int32())),
+            ("prediction", pa.string()),
+            ("correct", pa.bool_()),
+            ("prompt_tokens", pa.int64()),
+            ("completion_tokens", pa.int64()),
+            ("cached_tokens", pa.int64()),
+            ("latency", pa.float64()),
+            ("cost", pa.float64()),
+        ]
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        # Parquet files can't be appended to, so every sync adds a new part.
+        # Parts are written under a hidden name first, which readers skip.
+        if not self.rows:
+            return
+        table = self.pa.Table.from_pylist(self.rows, schema=self.schema)
+        name = f"part-{self.parts:05d}.parquet"
+        tmp_path = os.path.join(self.path, "." + name)
+        self.pq.write_table(table, tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, name))
+        self.parts += 1
+        self.rows = []
+
+    def close(self):
+        self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_results(path, output_format="jsonl"):
+    # Every item saved in a jsonl file or row of a parquet directory
+    if output_format == "parquet":
+        if not load_completed_parquet_ids(path):
+            return []
+        import pyarrow.parquet as pq
+
+        return pq.read_table(path).to_pylist()
+    if not os.path.exists(path):
+        return []
+    # Drops a last line cut short by a crash
+    load_completed_ids(path)
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def summarize_results(results):
+    return {
+        "items": len(results),
+        "accuracy": (
+            sum(r["correct"] for r in results) / len(results) if results else None
+        ),
+        "cost": round(sum(r["cost"] for r in results), 6),
+    }
+
+
+def write_results(
+    path, results, output_format="jsonl", parquet_writer=ParquetResultWriter
+):
+    # Write next to the output and swap it in once complete
+    tmp_path = path + ".tmp"
+    if output_format == "parquet":
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        with parquet_writer(tmp_path, sync_every=len(results) + 1) as writer:
+            for result in results:
+                writer.write_row(result)
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        with ResultWriter(tmp_path, truncate=True) as writer:
+            for result in results:
+                writer.write(result)
+    os.replace(tmp_path, path)
+
+
+def sort_results(path, ids, output_format="jsonl", parquet_writer=ParquetResultWriter):
+    # Async runs write every item as soon as it is scored, put the output back
+    # in dataset order once the run is over
+    positions = {id: i for i, id in enumerate(ids)}
+    results = read_results(path, output_format)
+    order = [positions[r["id"]] for r in results]
+    if order == sorted(order):
+        return
+    results = sorted(results, key=lambda r: positions[r["id"]])
+    write_results(path, results, output_format, parquet_writer=parquet_writer)
+
+
+def merge_shards(
+    path,
+    ids,
+    num_shards,
+    start=0,
+    limit=0,
+    output_format="jsonl",
+    parquet_writer=ParquetResultWriter,
+):
+    # Join the shards, and an earlier merge, into one output in dataset order.
+    # The first copy of an item is kept, so merging again is harmless.
+    positions = {id: i for i, id in enumerate(ids)}
+    merged = {}
+    shards = []
+    sources = [path] + [shard_path(path, num_shards, k) for k in range(num_shards)]
+    for source in sources:
+        results = read_results(source, output_format)
+        for result in results:
+            merged.setdefault(result["id"], result)
+        shards.append({"path": source, **summarize_results(results)})
+    results = sorted(merged.values(), key=lambda r: positions[r["id"]])
+    write_results(path, results, output_format, parquet_writer=parquet_writer)
+
+    expected = [ids[i] for i in shard_range(len(ids), start, limit)]
+    missing = [id for id in expected if id not in merged]
+    summary = {
+        **summarize_results(results),
+        "missing": len(missing),
+        "missing_ids": missing,
+        "shards": shards,
+    }
+    summary_path = os.path.splitext(path)[0] + "_summary.json"
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    for shard in shards[1:]:
+        print(f"{shard['path']}: {shard['items']} items")
+    accuracy = summary["accuracy"] or 0.0
+    print(
+        f"Merged {len(results)} items into {path}: {accuracy:.2%} accuracy, "
+        f"${summary['cost']:.4f} cost, {len(missing)} missing"
+    )
+    return summary
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=2**30, read_only=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        if read_only:
+            self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used "
+                "ON responses (last_used)"
+            )
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(kwargs):
+        # Same model, prompt and sampling parameters give the same key
+        request = json.dumps(kwargs, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, kwargs):
+        key = self.key(kwargs)
+        row = self.db.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            if self.read_only:
+                raise KeyError(f"Request {key} is not in {self.path}")
+            return None
+        self.hits += 1
+        if not self.read_only:
+            self.db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(row[0])
+
+    def put(self, kwargs, response):
+        if self.read_only:
+            return
+        key = self.key(kwargs)
+        data = json.dumps(response)
+        row = self.db.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            self.size -= row[0]
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, data, len(data), time.time()),
+        )
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used responses until the cache is 90% full
+        keys = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            keys.append((key,))
+            self.size -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def close(self):
+        if self.hits or self.misses:
+            print(f"Response cache: {self.hits} hits, {self.misses} misses")
+        self.db.close()
+
+
+def print_plan(
+    n_requests,
+    prompt_tokens,
+    completion_tokens,
+    cost,
+    batch_cost,
+    concurrency=32,
+    rpm=None,
+    tpm=None,
+    request_latency=1.0,
+):
+    tokens = prompt_tokens + completion_tokens
+
+    # Runs are bound by the latency at the number of requests in flight, or
+    # by the rate limits when they are known
+    def runtime(in_flight):
+        seconds = n_requests * request_latency / in_flight
+        if rpm is not None:
+            seconds = max(seconds, n_requests * 60 / rpm)
+        if tpm is not None:
+            seconds = max(seconds, tokens * 60 / tpm)
+        return seconds / 60
+
+    print(
+        f"** Plan **\n"
+        f"Requests: {n_requests:,}\n"
+        f"Prompt tokens: {prompt_tokens:,}\n"
+        f"Completion tokens: {completion_tokens:,}\n"
+        f"Cost: ${cost:.4f} (batch mode: ${batch_cost:.4f})\n"
+        f"Runtime: {runtime(1):.1f} min sync, "
+        f"{runtime(concurrency):.1f} min async with concurrency {concurrency}\n"
+    )
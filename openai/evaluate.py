@@ -1,44 +1,76 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+from local_batch import LocalBatchClient
+import asyncio
 import os
-from datasets import load_dataset
-import random
+import sys
 import argparse
+import functools
 import json
+import math
+import re
+import time
+from statistics import NormalDist
 from tenacity import (
     retry,
     stop_after_attempt,
-    wait_random_exponential,
 )  # for exponential backoff
 
-seed = 42
-random.seed(seed)
+# The code shared by the evaluators of every provider is in common/
+common_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"
+)
+sys.path.insert(0, common_dir)
+import evaluation
+from evaluation import (
+    FewShotSampler,
+    ResponseCache,
+    ResultWriter,
+    Telemetry,
+    answer2letter,
+    check_cache_prefix,
+    draw_few_shots,
+    estimate_tokens,
+    get_rate_limiter,
+    load_bertaqa,
+    load_completed_ids,
+    load_completed_parquet_ids,
+    load_correct,
+    load_spent,
+    merge_shards,
+    new_call_stats,
+    parse_answer,
+    print_plan,
+    seed,
+    shard_path,
+    sort_results,
+    stratified_order,
+    wait_for_rate_limit,
+    wilson_interval,
+    write_dead_letter,
+)
 
 # Set your OpenAI API key from environment variable
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are left to completion_with_backoff, so they are paced by the rate
+# limiter and counted in the telemetry
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
-answer2letter = {0: "A", 1: "B", 2: "C"}
+# Prices per model are kept in a registry next to this script
+pricing_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pricing.json")
 
+# Token ids of the answer letters, the same in cl100k_base and o200k_base
+letter_token_ids = {"A": 32, "B": 33, "C": 34}
 
-def load_bertaqa(config="eu"):
-    dataset = load_dataset("HiTZ/bertaqa", name=config, split="test")
-    return dataset
+# Batch API requests are billed at half the synchronous price
+batch_discount = 0.5
 
+# Prompt tokens served from the automatic prompt cache are billed at half price
+cached_prompt_discount = 0.5
 
-def format_question(item, config="eu"):
-    question = item["question"]
-    candidates = item["candidates"]
 
-    # Format the question with the given prompt
-    if config == "eu":
-        formatted_question = f"Galdera: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nErantzuna:"
-    elif config in ["en", "en_mt"]:
-        formatted_question = f"Question: {question}\nA: {candidates[0]}\nB: {candidates[1]}\nC: {candidates[2]}\nAnswer:"
-    else:
-        raise ValueError("config must be 'eu', 'en' or 'en_mt'")
-    return formatted_question
-
-
-def few_shot_messages(few_shot_examples, config="eu"):
+def few_shot_messages(few_shot_indices, sampler):
     # Add the few-shot examples to the prompt
     messages = [
         {
@@ -46,112 +78,971 @@ def few_shot_messages(few_shot_examples, config="eu"):
             "content": "Respond always with a single letter: A, B or C.",
         }
     ]
-    for example in few_shot_examples:
-        messages.append({"role": "user", "content": format_question(example, config)})
-        messages.append(
-            {"role": "assistant", "content": answer2letter[example["answer"]]}
-        )
+    for j in few_shot_indices:
+        messages.append({"role": "user", "content": sampler.questions[j]})
+        messages.append({"role": "assistant", "content": sampler.letters[j]})
     return messages
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return client.chat.completions.create(**kwargs)
-
-
-def openai_api_calculate_cost(usage, model="gpt-4-0125-preview"):
-    pricing = {
-        'gpt-3.5-turbo-0125': {
-            'prompt': 0.0005,
-            'completion': 0.0015,
-        },
-        'gpt-4-0125-preview': {
-            'prompt': 0.01,
-            'completion': 0.03,
-        },
-        'gpt-4-0613': {
-            'prompt': 0.03,
-            'completion': 0.06,
-        }
-    }
+def parse_reset(value):
+    # Reset times look like "1s", "6m0s" or "20ms"
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def rate_limit_headers(headers):
+    limits = {}
+    for key in ["limit_requests", "remaining_requests", "limit_tokens", "remaining_tokens"]:
+        value = headers.get("x-ratelimit-" + key.replace("_", "-"))
+        if value is not None:
+            limits[key] = int(value)
+    for key in ["reset_requests", "reset_tokens"]:
+        value = headers.get("x-ratelimit-" + key.replace("_", "-"))
+        if value is not None:
+            limits[key] = parse_reset(value)
+    return limits
+
+
+# Calls of every model in this run
+telemetry = Telemetry()
+
+
+@retry(wait=wait_for_rate_limit, stop=stop_after_attempt(6))
+def completion_with_backoff(stats=None, **kwargs):
+    limiter = get_rate_limiter(kwargs["model"])
+    estimated = estimate_tokens(kwargs)
+    started = time.perf_counter()
+    limiter.acquire(estimated)
+    throttle = time.perf_counter() - started
+    raw = client.chat.completions.with_raw_response.create(**kwargs)
+    completion = raw.parse()
+    limiter.update(rate_limit_headers(raw.headers))
+    limiter.record(estimated, completion.usage.total_tokens)
+    if stats is not None:
+        stats["status"] = raw.status_code
+        stats["throttle"] += throttle
+        stats["prompt_tokens"] = completion.usage.prompt_tokens
+        stats["completion_tokens"] = completion.usage.completion_tokens
+    return completion
+
+
+@retry(wait=wait_for_rate_limit, stop=stop_after_attempt(6))
+async def async_completion_with_backoff(stats=None, **kwargs):
+    limiter = get_rate_limiter(kwargs["model"])
+    estimated = estimate_tokens(kwargs)
+    started = time.perf_counter()
+    await limiter.acquire_async(estimated)
+    throttle = time.perf_counter() - started
+    raw = await async_client.chat.completions.with_raw_response.create(**kwargs)
+    completion = raw.parse()
+    limiter.update(rate_limit_headers(raw.headers))
+    limiter.record(estimated, completion.usage.total_tokens)
+    if stats is not None:
+        stats["status"] = raw.status_code
+        stats["throttle"] += throttle
+        stats["prompt_tokens"] = completion.usage.prompt_tokens
+        stats["completion_tokens"] = completion.usage.completion_tokens
+    return completion
+
+
+@retry(wait=wait_for_rate_limit, stop=stop_after_attempt(6))
+async def packed_completion_with_backoff(completions_client, stats=None, **kwargs):
+    # Legacy completions with a list of prompts, for OpenAI-compatible servers.
+    # Every pack goes through the model's limiter, so a 429 holds back all the
+    # packs in flight and not just the one that got it.
+    limiter = get_rate_limiter(kwargs["model"])
+    estimated = sum(len(prompt) // 4 + 1 for prompt in kwargs["prompt"])
+    started = time.perf_counter()
+    await limiter.acquire_async(estimated)
+    throttle = time.perf_counter() - started
+    raw = await completions_client.completions.with_raw_response.create(**kwargs)
+    completion = raw.parse()
+    limiter.update(rate_limit_headers(raw.headers))
+    # Some servers leave out the usage, which then counts as no tokens
+    usage = completion.usage
+    if usage is not None:
+        limiter.record(estimated, usage.total_tokens)
+    if stats is not None:
+        stats["status"] = raw.status_code
+        stats["throttle"] += throttle
+        stats["prompt_tokens"] = usage.prompt_tokens if usage is not None else 0
+        stats["completion_tokens"] = (
+            usage.completion_tokens if usage is not None else 0
+        )
+    return completion
+
+
+@functools.lru_cache(maxsize=None)
+def load_pricing(path=pricing_path):
+    # Prices in dollars per 1000 tokens, by model
+    with open(path) as f:
+        return json.load(f)
+
+
+def openai_api_calculate_cost(usage, model="gpt-4-0125-preview", batch=False):
+    pricing = load_pricing()
 
     try:
         model_pricing = pricing[model]
     except KeyError:
-        raise ValueError("Invalid model specified")
+        raise ValueError(f"Invalid model specified, add its prices to {pricing_path}")
 
-    prompt_cost = usage.prompt_tokens * model_pricing['prompt'] / 1000
+    # Cached tokens are part of prompt_tokens, but billed at a discount
+    cached_tokens = 0
+    if usage.prompt_tokens_details is not None:
+        cached_tokens = usage.prompt_tokens_details.cached_tokens or 0
+
+    prompt_cost = (
+        (usage.prompt_tokens - cached_tokens) * model_pricing['prompt']
+        + cached_tokens * model_pricing['prompt'] * cached_prompt_discount
+    ) / 1000
     completion_cost = usage.completion_tokens * model_pricing['completion'] / 1000
 
     total_cost = prompt_cost + completion_cost
+    if batch:
+        total_cost *= batch_discount
     # round to 6 decimals
     total_cost = round(total_cost, 6)
 
     return total_cost
 
 
-def evaluate_bertaqa(config="test", model="gpt-3.5-turbo", shots=5, limit=1, start=0):
-    # Load your dataset from Hugging Face
-    print(f"Loading {config} config...")
-    dataset = load_bertaqa(config=config)
+def request_kwargs(item, model, scoring="text", logit_bias=False):
+    # Use the chat models, which are better for multi-turn conversation
+    kwargs = dict(
+        model=model,
+        messages=item["messages"],
+        temperature=0,
+        seed=seed,
+    )
+    if scoring == "logprobs":
+        # A single token is enough to read the distribution over the letters
+        kwargs["max_tokens"] = 1
+        kwargs["logprobs"] = True
+        kwargs["top_logprobs"] = 20
+        if logit_bias:
+            kwargs["logit_bias"] = {
+                str(token_id): 100 for token_id in letter_token_ids.values()
+            }
+    elif scoring == "constrained":
+        # A single token, and only A, B or C can be generated
+        kwargs["max_tokens"] = 1
+        kwargs["logit_bias"] = {
+            str(token_id): 100 for token_id in letter_token_ids.values()
+        }
+    elif scoring != "text":
+        raise ValueError("scoring must be 'text', 'logprobs' or 'constrained'")
+    return kwargs
 
-    # Create the results directory if it doesn't exist
-    os.makedirs(f"../results/{model}", exist_ok=True)
 
-    tokens = 0
-    cost = 0 
+def letter_probs(top_logprobs):
+    # Probability of each letter, normalized over A, B and C
+    logprobs = {}
+    for top in top_logprobs:
+        letter = top["token"].strip()
+        if letter in letter_token_ids and letter not in logprobs:
+            logprobs[letter] = top["logprob"]
+    if not logprobs:
+        return None
+    total = sum(math.exp(logprob) for logprob in logprobs.values())
+    return {
+        letter: math.exp(logprobs[letter]) / total if letter in logprobs else 0.0
+        for letter in letter_token_ids
+    }
 
-    # Iterate over your dataset and use the API
-    for i, item in enumerate(dataset):
-        if i < start:
-            continue
 
-        # Get 5 random few-shot examples
-        few_shot_examples = random.sample([ex for ex in dataset if ex != item], shots)
+def cached_completion(kwargs, cache=None):
+    # Serve requests that were already sent from the local response cache.
+    # Returns the call stats of the API call, or None for a cache hit.
+    if cache is not None:
+        response = cache.get(kwargs)
+        if response is not None:
+            return ChatCompletion.model_validate(response), None
+    stats = new_call_stats()
+    started = time.perf_counter()
+    try:
+        completion = completion_with_backoff(stats=stats, **kwargs)
+    finally:
+        stats["wall"] = time.perf_counter() - started
+        telemetry.record(kwargs["model"], stats)
+    return completion, stats
+
+
+async def async_cached_completion(kwargs, cache=None):
+    if cache is not None:
+        response = cache.get(kwargs)
+        if response is not None:
+            return ChatCompletion.model_validate(response), None
+    stats = new_call_stats()
+    started = time.perf_counter()
+    try:
+        completion = await async_completion_with_backoff(stats=stats, **kwargs)
+    finally:
+        stats["wall"] = time.perf_counter() - started
+        telemetry.record(kwargs["model"], stats)
+    return completion, stats
+
+
+def score_completion(item, completion, model, batch=False):
+    # convert completions to dict
+    response = completion.model_dump()
+
+    # Save whole response along with the original dataset fields to a jsonl file
+    item["response"] = response
+
+    choice = response["choices"][0]
+    if choice["logprobs"] is not None:
+        # Logprob scoring: pick the most likely letter and keep the distribution
+        probs = letter_probs(choice["logprobs"]["content"][0]["top_logprobs"])
+        item["letter_probs"] = probs
+        item["prediction"] = max(probs, key=probs.get) if probs else None
+        item["correct"] = item["prediction"] == answer2letter[item["answer"]]
+    else:
+        # Check if the answer is correct
+        item["prediction"] = parse_answer(choice["message"]["content"] or "")
+        item["correct"] = item["prediction"] == answer2letter[item["answer"]]
+
+    # Calculate OpenAI API cost and add to the item
+    item["cost"] = openai_api_calculate_cost(completion.usage, model, batch=batch)
+    return item
+
+
+def slim_result(item):
+    # The columns kept in the parquet output, prompts are rebuilt from the
+    # few-shot indices with regenerate_messages
+    response = item["response"]
+    usage = response["usage"]
+    prompt_tokens_details = usage.get("prompt_tokens_details") or {}
+    probs = item.get("letter_probs")
+    return {
+        "id": item["id"],
+        "position": item["position"],
+        "few_shot_indices": item["few_shot_indices"],
+        "prediction": item["prediction"],
+        "correct": item["correct"],
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "cached_tokens": prompt_tokens_details.get("cached_tokens") or 0,
+        "latency": item.get("latency"),
+        "cost": item["cost"],
+        "letter_probs": (
+            [probs[letter] for letter in letter_token_ids] if probs else None
+        ),
+    }
+
+
+def regenerate_messages(result, sampler):
+    # Full prompt of a result row, the same that was sent to the model
+    messages = few_shot_messages(result["few_shot_indices"], sampler)
+    index = sampler.positions[result["id"]]
+    messages.append({"role": "user", "content": sampler.questions[index]})
+    return messages
+
+
+class ParquetResultWriter(evaluation.ParquetResultWriter):
+    def fields(self, pa):
+        return super().fields(pa) + [("letter_probs", pa.list_(pa.float64()))]
+
+    def write(self, item):
+        self.write_row(slim_result(item))
+
+
+def build_requests(
+    sampler, model, few_shots, completed=(), scoring="text", logit_bias=False
+):
+    requests = []
+    for i, few_shot_indices in few_shots:
+        item = dict(sampler.rows[i])
+        if item["id"] in completed:
+            continue
 
         # Add the few-shot examples to the prompt
-        messages = few_shot_messages(few_shot_examples, config)
+        messages = few_shot_messages(few_shot_indices, sampler)
 
-        messages.append({"role": "user", "content": format_question(item, config)})
+        messages.append({"role": "user", "content": sampler.questions[i]})
 
-        # Save messages along with the original dataset fields to a jsonl file
+        # Save messages along with the original dataset fields to a jsonl file.
+        # The position keeps the dataset order of results written out of order.
+        item["position"] = i
+        item["few_shot_indices"] = few_shot_indices
         item["messages"] = messages
+        kwargs = request_kwargs(item, model, scoring=scoring, logit_bias=logit_bias)
+        requests.append((i, item, kwargs))
+    return requests
 
-        # Use the chat models, which are better for multi-turn conversation
-        completion = completion_with_backoff(
-            model=model,
-            messages=messages,
-            temperature=0,
-            seed=seed,
-        )
 
-        # convert completions to dict
-        response = completion.model_dump()
+def evaluate_sync(requests, model, writer, cache=None, max_cost=None, spent=0):
+    tokens = 0
+    # Resumed runs start from the cost of the items already written
+    cost = spent
 
-        # Save whole response along with the original dataset fields to a jsonl file
-        item["response"] = response
+    for i, item, kwargs in requests:
+        if max_cost is not None and cost >= max_cost:
+            print(f"Reached the ${max_cost:.2f} budget, run again with a higher one to resume")
+            break
 
-        # Check if the answer is correct
-        item["correct"] = (
-            response["choices"][0]["message"]["content"]
-            == answer2letter[item["answer"]]
+        started = time.perf_counter()
+        completion, stats = cached_completion(kwargs, cache)
+        latency = time.perf_counter() - started
+        item = score_completion(item, completion, model)
+        item["latency"] = round(latency, 3)
+        if stats is None:
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            item["telemetry"] = stats
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+
+        cost += item["cost"]
+        tokens += completion.usage.total_tokens
+
+        # Print details in a line: i, total tokens and total cost
+        print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
+
+        writer.write(item)
+
+
+async def evaluate_async(
+    requests,
+    model,
+    writer,
+    concurrency=32,
+    cache=None,
+    max_cost=None,
+    semaphore=None,
+    stop=None,
+    spent=0,
+):
+    tokens = 0
+    # Resumed runs start from the cost of the items already written
+    cost = spent
+    # The cost of the finished requests, written or not, is added to spent,
+    # which is checked against the budget
+    # Set once stop, called with every scored item, returns True. The requests
+    # in flight are still written, no new one is sent.
+    stopped = False
+
+    # Keep at most `concurrency` requests in flight, or share the limit with
+    # other runs of the same model
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i, item, kwargs):
+        nonlocal spent, stopped
+        async with semaphore:
+            if stopped or (max_cost is not None and spent >= max_cost):
+                return i, None, None
+            started = time.perf_counter()
+            try:
+                completion, stats = await async_cached_completion(kwargs, cache)
+            except Exception as e:
+                # Out of retries, the other requests go on without this item
+                print(f"{i + 1}: {type(e).__name__}: {e}, left for the next run")
+                return i, None, None
+            latency = time.perf_counter() - started
+        item = score_completion(item, completion, model)
+        item["latency"] = round(latency, 3)
+        if stats is None:
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            item["telemetry"] = stats
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+        spent += item["cost"]
+        if stop is not None and not stopped and stop(item):
+            stopped = True
+        return i, item, completion.usage
+
+    tasks = [asyncio.create_task(run(*request)) for request in requests]
+
+    # Every item is written as soon as it is scored, so a slow or failing
+    # request holds back no other. The items keep their dataset position, and
+    # the output is sorted once the run is over.
+    for task in asyncio.as_completed(tasks):
+        i, item, usage = await task
+        if item is None:
+            # Not sent because the budget ran out, or failed, left for the next run
+            continue
+
+        cost += item["cost"]
+        tokens += usage.total_tokens
+
+        # Print details in a line: i, total tokens and total cost
+        print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
+
+        writer.write(item)
+
+    if max_cost is not None and spent >= max_cost:
+        print(f"Reached the ${max_cost:.2f} budget, run again with a higher one to resume")
+
+
+async def evaluate_triage(
+    requests,
+    model,
+    writer,
+    target_halfwidth=0.03,
+    confidence=0.95,
+    min_items=30,
+    concurrency=32,
+    cache=None,
+    max_cost=None,
+    correct=(),
+    spent=0,
+):
+    # Items are sent in a stratified random order, keeping `concurrency`
+    # requests in flight, until the confidence interval of the accuracy is
+    # narrow enough. The output file can later be completed by a full run.
+    correct = list(correct)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def narrow_enough():
+        low, high = wilson_interval(sum(correct), len(correct), z)
+        if correct:
+            print(
+                f"Accuracy {sum(correct) / len(correct):.3f} "
+                f"({low:.3f}-{high:.3f}) after {len(correct)} items"
+            )
+        if len(correct) >= min_items and (high - low) / 2 <= target_halfwidth:
+            print(f"Interval half-width below {target_halfwidth}, stopping")
+            return True
+        return False
+
+    def stop(item):
+        # Checked as every result arrives, not once per round of requests
+        correct.append(item["correct"])
+        return narrow_enough()
+
+    # An earlier run may have already narrowed the interval enough
+    if narrow_enough():
+        return
+    await evaluate_async(
+        stratified_order(requests),
+        model,
+        writer,
+        concurrency=concurrency,
+        cache=cache,
+        max_cost=max_cost,
+        spent=spent,
+        stop=stop,
+    )
+
+
+def evaluate_batch(
+    requests,
+    model,
+    writer,
+    batch_client,
+    batch_dir,
+    batch_id=None,
+    poll_interval=60,
+    cache=None,
+):
+    # Only the requests missing from the response cache go into the batch
+    hits = {}
+    if cache is not None:
+        for i, item, kwargs in requests:
+            response = cache.get(kwargs)
+            if response is not None:
+                hits[i] = response
+    misses = [request for request in requests if request[0] not in hits]
+
+    results = {}
+    if batch_id is not None or misses:
+        results = run_batch(
+            misses,
+            model,
+            writer,
+            batch_client,
+            batch_dir,
+            batch_id=batch_id,
+            poll_interval=poll_interval,
         )
-        
-                # Calculate OpenAI API cost and add to the item
-        item["cost"] = openai_api_calculate_cost(completion.usage, model)
-        
+
+    tokens = 0
+    cost = 0
+
+    # Join the batch results back to the items in dataset order
+    for i, item, kwargs in requests:
+        if i in hits:
+            completion = ChatCompletion.model_validate(hits[i])
+            item = score_completion(item, completion, model)
+            # Served from the local cache, nothing was paid for it
+            item["cost"] = 0.0
+        else:
+            result = results.get(str(i))
+            if (
+                result is None
+                or result["error"]
+                or result["response"]["status_code"] != 200
+            ):
+                print(f"{i + 1}: no result in batch, skipping")
+                continue
+
+            completion = ChatCompletion.model_validate(result["response"]["body"])
+            item = score_completion(item, completion, model, batch=True)
+            if cache is not None:
+                cache.put(kwargs, item["response"])
+
         cost += item["cost"]
         tokens += completion.usage.total_tokens
-        
+
         # Print details in a line: i, total tokens and total cost
         print(f"{i + 1}: ${cost:.4f} total cost, {tokens:,} tokens")
 
-        with open(f"../results/{model}/bertaqa_{config}_{shots}-shot.jsonl", "a") as f:
-            json.dump(item, f)
-            f.write("\n")
+        writer.write(item)
+
+
+def run_batch(
+    requests, model, writer, batch_client, batch_dir, batch_id=None, poll_interval=60
+):
+    if batch_id is None:
+        # Write the same request bodies as the other modes to a batch input file
+        os.makedirs(batch_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(writer.path))[0] + "_batch_input.jsonl"
+        input_path = os.path.join(batch_dir, name)
+        with open(input_path, "w") as f:
+            for i, item, kwargs in requests:
+                request = {
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": kwargs,
+                }
+                json.dump(request, f)
+                f.write("\n")
+
+        with open(input_path, "rb") as f:
+            input_file = batch_client.files.create(file=f, purpose="batch")
+        batch = batch_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch.id} with {len(requests)} requests")
+    else:
+        batch = batch_client.batches.retrieve(batch_id)
+
+    while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+        print(f"Batch {batch.id} is {batch.status}, checking again in {poll_interval}s")
+        time.sleep(poll_interval)
+        batch = batch_client.batches.retrieve(batch.id)
+
+    if batch.output_file_id is None:
+        raise RuntimeError(f"Batch {batch.id} {batch.status} without any output")
+
+    results = {}
+    for line in batch_client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        results[result["custom_id"]] = result
+    return results
+
+
+def completion_prompt(item):
+    # The few-shot prompt as plain text, in the lm_eval format: examples
+    # separated by a blank line, each with its letter after the question.
+    # Base models get no system prompt.
+    parts = []
+    for message in item["messages"]:
+        if message["role"] == "user":
+            parts.append(message["content"])
+        elif message["role"] == "assistant":
+            parts[-1] += " " + message["content"]
+    return "\n\n".join(parts)
+
+
+def score_completion_choice(item, choice, model):
+    # Pick the most likely letter from the logprobs of the first token
+    response = choice.model_dump()
+    item["response"] = {
+        "model": model,
+        "choices": [response],
+        # Servers only report the usage of the whole request
+        "usage": {"prompt_tokens": None, "completion_tokens": 1},
+    }
+    # Some servers leave out the logprobs, the item is then set aside
+    logprobs = response["logprobs"] or {}
+    if not logprobs.get("top_logprobs") or not logprobs["top_logprobs"][0]:
+        raise IndexError("choice without logprobs")
+    top_logprobs = logprobs["top_logprobs"][0]
+    probs = letter_probs(
+        [
+            {"token": token, "logprob": logprob}
+            for token, logprob in sorted(
+                top_logprobs.items(), key=lambda x: x[1], reverse=True
+            )
+        ]
+    )
+    item["letter_probs"] = probs
+    item["prediction"] = max(probs, key=probs.get) if probs else None
+    item["correct"] = item["prediction"] == answer2letter[item["answer"]]
+    # Local models are free
+    item["cost"] = 0.0
+    return item
+
+
+async def evaluate_completions(
+    requests,
+    model,
+    writer,
+    completions_client,
+    prompts_per_request=32,
+    concurrency=4,
+    dead_letters=None,
+):
+    # Pack many prompts into each request, so that the server can batch them,
+    # and keep a few requests in flight
+    semaphore = asyncio.Semaphore(concurrency)
+    packs = [
+        requests[k : k + prompts_per_request]
+        for k in range(0, len(requests), prompts_per_request)
+    ]
+
+    async def run(p, pack):
+        kwargs = dict(
+            model=model,
+            prompt=[completion_prompt(item) for _, item, _ in pack],
+            max_tokens=1,
+            temperature=0,
+            logprobs=20,
+        )
+        async with semaphore:
+            stats = new_call_stats()
+            started = time.perf_counter()
+            try:
+                completion = await packed_completion_with_backoff(
+                    completions_client, stats=stats, **kwargs
+                )
+            except Exception as e:
+                # Out of retries, the other packs go on without this one
+                print(
+                    f"{pack[0][0] + 1}-{pack[-1][0] + 1}: {type(e).__name__}: {e}, "
+                    "left for the next run"
+                )
+                return p, None, None, pack[-1][0]
+            finally:
+                stats["wall"] = time.perf_counter() - started
+                telemetry.record(model, stats)
+        # Choices come back with the index of their prompt
+        choices = sorted(completion.choices, key=lambda choice: choice.index)
+        items = []
+        for (i, item, _), choice in zip(pack, choices):
+            try:
+                item = score_completion_choice(item, choice, model)
+            except IndexError as e:
+                error = f"IndexError: {e}"
+                write_dead_letter(dead_letters, item, choice, 1, 0.0, error=error)
+                continue
+            item["latency"] = round(stats["wall"], 3)
+            items.append((i, item))
+        return p, items, completion.usage, pack[-1][0]
+
+    tasks = [asyncio.create_task(run(p, pack)) for p, pack in enumerate(packs)]
+
+    # Write every pack as soon as it is scored, as evaluate_async does with
+    # the items
+    tokens = 0
+    for task in asyncio.as_completed(tasks):
+        p, items, usage, last = await task
+        if items is None:
+            continue
+        # Servers that leave out the usage report no tokens
+        tokens += usage.total_tokens if usage is not None else 0
+        for i, item in items:
+            writer.write(item)
+        # Print details in a line: i and total tokens
+        print(f"{last + 1}: {tokens:,} tokens")
 
-        if i == limit - 1:
-            break
+
+def count_tokens(kwargs, encoding):
+    # Every chat message adds a few formatting tokens to its content
+    tokens = 3
+    for message in kwargs["messages"]:
+        tokens += 3 + len(encoding.encode(message["content"]))
+    return tokens
+
+
+def plan_run(
+    requests, model, concurrency=32, rpm=None, tpm=None, request_latency=1.0
+):
+    # tiktoken is only needed to plan runs
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+
+    prompt_tokens = sum(count_tokens(kwargs, encoding) for _, _, kwargs in requests)
+    # Answers are a single letter
+    completion_tokens = len(requests)
+    usage = CompletionUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+    cost = openai_api_calculate_cost(usage, model)
+    batch_cost = openai_api_calculate_cost(usage, model, batch=True)
+
+    print_plan(
+        len(requests),
+        prompt_tokens,
+        completion_tokens,
+        cost,
+        batch_cost,
+        concurrency=concurrency,
+        rpm=rpm,
+        tpm=tpm,
+        request_latency=request_latency,
+    )
+    return cost
+
+
+def evaluate_bertaqa(
+    config="test",
+    model="gpt-3.5-turbo",
+    shots=5,
+    limit=None,
+    start=0,
+    mode="sync",
+    concurrency=32,
+    batch_endpoint="openai",
+    batch_id=None,
+    poll_interval=60,
+    shot_buckets=0,
+    cache="off",
+    cache_path="../results/responses.sqlite",
+    cache_max_mb=1024,
+    rpm=None,
+    tpm=None,
+    scoring="text",
+    logit_bias=False,
+    max_cost=None,
+    request_latency=1.0,
+    output_format="jsonl",
+    target_halfwidth=0.03,
+    confidence=0.95,
+    metrics_path=None,
+    dataset_path=None,
+    num_shards=1,
+    shard_id=0,
+    quota_share=None,
+    base_url=None,
+    prompts_per_request=32,
+):
+    # Triage picks its own sample and merge checks every item, so both cover
+    # the whole range unless told otherwise
+    if limit is None:
+        limit = 0 if mode in ["triage", "merge"] else 1
+
+    # Load your dataset from Hugging Face
+    print(f"Loading {config} config...")
+    dataset = load_bertaqa(config=config, path=dataset_path)
+
+    # Create the results directory if it doesn't exist
+    os.makedirs(f"../results/{model}", exist_ok=True)
+    path = f"../results/{model}/bertaqa_{config}_{shots}-shot.{output_format}"
+
+    if mode == "merge":
+        merge_shards(
+            path,
+            dataset["id"],
+            num_shards,
+            start=start,
+            limit=limit,
+            output_format=output_format,
+            parquet_writer=ParquetResultWriter,
+        )
+        return
+
+    # Every shard writes its own file, joined afterwards with --mode merge
+    if num_shards > 1:
+        path = shard_path(path, num_shards, shard_id)
+    # Shards on the same key split its quota evenly unless told otherwise
+    if quota_share is None:
+        quota_share = 1 / num_shards
+
+    # Items already in the output file are skipped, so a crashed run can be resumed
+    if output_format == "jsonl":
+        completed = load_completed_ids(path)
+    elif output_format == "parquet":
+        completed = load_completed_parquet_ids(path)
+    else:
+        raise ValueError("output_format must be 'jsonl' or 'parquet'")
+    if completed:
+        print(f"Resuming, {len(completed)} items already in {path}")
+
+    # Build every prompt up front, each item gets the same few-shot
+    # examples in every mode
+    sampler = FewShotSampler(
+        dataset, config=config, shots=shots, buckets=shot_buckets
+    )
+    few_shots = draw_few_shots(
+        sampler, start=start, limit=limit, num_shards=num_shards, shard_id=shard_id
+    )
+    # OpenAI caches prompts automatically from 1024 tokens on
+    if shot_buckets > 0 and base_url is None:
+        check_cache_prefix(sampler, 1024)
+    requests = build_requests(
+        sampler,
+        model,
+        few_shots,
+        completed=completed,
+        scoring=scoring,
+        logit_bias=logit_bias,
+    )
+
+    if base_url is not None:
+        # Open models behind a local OpenAI-compatible server, e.g. vLLM. They
+        # are scored on the logprobs of the letters and cost nothing.
+        if mode not in ["sync", "async"]:
+            raise ValueError("base_url only supports the sync and async modes")
+        if cache != "off":
+            raise ValueError("base_url does not support the response cache")
+        completions_client = AsyncOpenAI(
+            base_url=base_url,
+            api_key=os.getenv("OPENAI_API_KEY") or "EMPTY",
+            max_retries=0,
+        )
+        telemetry.path = metrics_path
+        if output_format == "parquet":
+            writer = ParquetResultWriter(path)
+        else:
+            writer = ResultWriter(path)
+        # Items whose choices come back without logprobs are written here,
+        # and evaluated again by the next run
+        dead_letters = ResultWriter(os.path.splitext(path)[0] + "_dead_letters.jsonl")
+        with writer, dead_letters:
+            asyncio.run(
+                evaluate_completions(
+                    requests,
+                    model,
+                    writer,
+                    completions_client,
+                    prompts_per_request=prompts_per_request,
+                    concurrency=concurrency if mode == "async" else 1,
+                    dead_letters=dead_letters,
+                )
+            )
+        # Packs are written as they are scored
+        sort_results(
+            path, dataset["id"], output_format, parquet_writer=ParquetResultWriter
+        )
+        telemetry.summary()
+        return
+
+    if mode == "plan":
+        plan_run(
+            requests,
+            model,
+            concurrency=concurrency,
+            rpm=rpm * quota_share if rpm else rpm,
+            tpm=tpm * quota_share if tpm else tpm,
+            request_latency=request_latency,
+        )
+        return
+
+    # Requests are paced to the model's quota, learned from the response
+    # headers when it is not given
+    get_rate_limiter(model, rpm=rpm, tpm=tpm, share=quota_share)
+
+    # Latency, retries and throughput of the calls, exported while running
+    telemetry.path = metrics_path
+
+    if cache == "off":
+        response_cache = None
+    elif cache in ["on", "replay"]:
+        response_cache = ResponseCache(
+            cache_path,
+            max_bytes=cache_max_mb * 2**20,
+            read_only=cache == "replay",
+        )
+    else:
+        raise ValueError("cache must be 'off', 'on' or 'replay'")
+
+    if output_format == "parquet":
+        writer = ParquetResultWriter(path)
+    else:
+        writer = ResultWriter(path)
+
+    # Items already paid for count against the budget of a resumed run
+    spent = load_spent(path)
+
+    with writer:
+        if mode == "sync":
+            evaluate_sync(
+                requests,
+                model,
+                writer,
+                cache=response_cache,
+                max_cost=max_cost,
+                spent=spent,
+            )
+        elif mode == "async":
+            asyncio.run(
+                evaluate_async(
+                    requests,
+                    model,
+                    writer,
+                    concurrency=concurrency,
+                    cache=response_cache,
+                    max_cost=max_cost,
+                    spent=spent,
+                )
+            )
+        elif mode == "triage":
+            asyncio.run(
+                evaluate_triage(
+                    requests,
+                    model,
+                    writer,
+                    target_halfwidth=target_halfwidth,
+                    confidence=confidence,
+                    concurrency=concurrency,
+                    cache=response_cache,
+                    max_cost=max_cost,
+                    spent=spent,
+                    correct=load_correct(path),
+                )
+            )
+        elif mode == "batch":
+            if max_cost is not None:
+                raise ValueError("max_cost is not supported in batch mode")
+            batch_dir = f"../results/{model}/batches"
+            if batch_endpoint == "openai":
+                batch_client = client
+            elif batch_endpoint == "local":
+                batch_client = LocalBatchClient(os.path.join(batch_dir, "local"))
+            else:
+                raise ValueError("batch_endpoint must be 'openai' or 'local'")
+            evaluate_batch(
+                requests,
+                model,
+                writer,
+                batch_client,
+                batch_dir,
+                batch_id=batch_id,
+                poll_interval=poll_interval,
+                cache=response_cache,
+            )
+        else:
+            raise ValueError(
+                "mode must be 'sync', 'async', 'triage', 'batch', 'plan' or 'merge'"
+            )
+
+    # Async runs write the items as they are scored
+    if mode in ["async", "triage"]:
+        sort_results(
+            path, dataset["id"], output_format, parquet_writer=ParquetResultWriter
+        )
+
+    telemetry.summary()
+
+    if response_cache is not None:
+        response_cache.close()
 
 
 def main():
@@ -167,14 +1058,212 @@ def main():
         "--shots", type=int, default=5, help="Number of few-shot examples"
     )
     parser.add_argument(
-        "--limit", type=int, default=1, help="Number of examples to evaluate"
+        "--limit",
+        type=int,
+        default=None,
+        help="Number of examples to evaluate, 0 for all the examples from --start. "
+        "By default 0 in triage and merge modes and 1 otherwise",
     )
     parser.add_argument(
         "--start", type=int, default=0, help="Start index of the examples to evaluate"
     )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="sync",
+        choices=["sync", "async", "triage", "batch", "plan", "merge"],
+        help="Send one request at a time (sync), many concurrently (async) "
+        "or all of them through the Batch API (batch)."
+        " The plan mode only projects the tokens, cost and runtime of the run,"
+        " and the triage mode stops once the accuracy is known well enough."
+        " The merge mode joins the files of the shards into one",
+    )
+    parser.add_argument(
+        "--target_halfwidth",
+        type=float,
+        default=0.03,
+        help="Half-width of the accuracy confidence interval at which the triage "
+        "mode stops",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the interval in triage mode",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Maximum number of requests in flight in async mode",
+    )
+    parser.add_argument(
+        "--batch_endpoint",
+        type=str,
+        default="openai",
+        choices=["openai", "local"],
+        help="Submit batches to the OpenAI Batch API or to a local file-based stand-in",
+    )
+    parser.add_argument(
+        "--batch_id",
+        type=str,
+        default=None,
+        help="Resume polling an already submitted batch instead of creating a new one",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=int,
+        default=60,
+        help="Seconds between batch status checks",
+    )
+    parser.add_argument(
+        "--shot_buckets",
+        type=int,
+        default=0,
+        help="Number of fixed few-shot sets shared across items, so requests reuse "
+        "a cached prompt prefix. 0 draws new few-shot examples for every item",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default="off",
+        choices=["off", "on", "replay"],
+        help="Serve repeated requests from a local response cache (on), "
+        "or only from the cache without calling the API (replay)",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default="../results/responses.sqlite",
+        help="SQLite file of the response cache",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=int,
+        default=1024,
+        help="Size of the response cache, least recently used responses are evicted above it",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Requests per minute allowed for the model, by default read from the rate limit headers",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="Tokens per minute allowed for the model, by default read from the rate limit headers",
+    )
+    parser.add_argument(
+        "--scoring",
+        type=str,
+        default="text",
+        choices=["text", "logprobs", "constrained"],
+        help="Compare the generated text with the answer (text), request a single "
+        "token with its top logprobs and pick the most likely letter (logprobs), "
+        "or generate a single token restricted to A, B and C (constrained)",
+    )
+    parser.add_argument(
+        "--logit_bias",
+        action="store_true",
+        help="Restrict the output to the A, B and C tokens in logprobs scoring",
+    )
+    parser.add_argument(
+        "--max_cost",
+        type=float,
+        default=None,
+        help="Stop the run once it has cost this many dollars, it can be resumed later",
+    )
+    parser.add_argument(
+        "--request_latency",
+        type=float,
+        default=1.0,
+        help="Seconds per request assumed by the plan mode to project the runtime",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="jsonl",
+        choices=["jsonl", "parquet"],
+        help="Save the full items as jsonl, or only the id, few-shot indices, "
+        "prediction, usage, latency and cost as a parquet dataset",
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help="Prometheus text file with the latency, retry and throughput metrics, "
+        "updated during the run",
+    )
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="Local jsonl file with the items of the config, instead of the Hub",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the examples in this many shards, each run as its own process "
+        "and written to its own file",
+    )
+    parser.add_argument(
+        "--shard_id", type=int, default=0, help="Shard to evaluate, from 0"
+    )
+    parser.add_argument(
+        "--quota_share",
+        type=float,
+        default=None,
+        help="Fraction of the model's rate limits used by this shard, 1/num_shards "
+        "by default. Use 1 when every shard has its own API key",
+    )
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="Evaluate an open model behind this OpenAI-compatible server, through "
+        "the legacy completions endpoint and the logprobs of the letters",
+    )
+    parser.add_argument(
+        "--prompts_per_request",
+        type=int,
+        default=32,
+        help="Number of prompts packed in each request to --base_url",
+    )
     args = parser.parse_args()
     evaluate_bertaqa(
-        config=args.config, model=args.model, shots=args.shots, limit=args.limit
+        config=args.config,
+        model=args.model,
+        shots=args.shots,
+        limit=args.limit,
+        start=args.start,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        batch_endpoint=args.batch_endpoint,
+        batch_id=args.batch_id,
+        poll_interval=args.poll_interval,
+        shot_buckets=args.shot_buckets,
+        cache=args.cache,
+        cache_path=args.cache_path,
+        cache_max_mb=args.cache_max_mb,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        scoring=args.scoring,
+        logit_bias=args.logit_bias,
+        max_cost=args.max_cost,
+        request_latency=args.request_latency,
+        output_format=args.output_format,
+        target_halfwidth=args.target_halfwidth,
+        confidence=args.confidence,
+        metrics_path=args.metrics_path,
+        dataset_path=args.dataset_path,
+        num_shards=args.num_shards,
+        shard_id=args.shard_id,
+        quota_share=args.quota_share,
+        base_url=args.base_url,
+        prompts_per_request=args.prompts_per_request,
     )
 
 
@@ -0,0 +1,142 @@
+import json
+import os
+import time
+import uuid
+from types import SimpleNamespace
+
+from openai.types import Batch, FileObject
+
+
+def answer_a(body):
+    return "A"
+
+
+class LocalFiles:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, file_id):
+        return os.path.join(self.root, f"{file_id}.jsonl")
+
+    def create(self, file, purpose="batch"):
+        file_id = f"file-{uuid.uuid4().hex}"
+        data = file.read()
+        with open(self.path(file_id), "wb") as f:
+            f.write(data)
+        return FileObject(
+            id=file_id,
+            bytes=len(data),
+            created_at=int(time.time()),
+            filename=os.path.basename(getattr(file, "name", file_id)),
+            object="file",
+            purpose=purpose,
+            status="processed",
+        )
+
+    def write(self, lines):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self.path(file_id), "w") as f:
+            for line in lines:
+                json.dump(line, f)
+                f.write("\n")
+        return file_id
+
+    def content(self, file_id):
+        with open(self.path(file_id)) as f:
+            return SimpleNamespace(text=f.read())
+
+
+class LocalBatches:
+    def __init__(self, root, files, respond):
+        self.root = root
+        self.files = files
+        self.respond = respond
+
+    def path(self, batch_id):
+        return os.path.join(self.root, f"{batch_id}.json")
+
+    def save(self, batch):
+        with open(self.path(batch.id), "w") as f:
+            f.write(batch.model_dump_json())
+        return batch
+
+    def create(self, input_file_id, endpoint, completion_window="24h", **kwargs):
+        batch = Batch(
+            id=f"batch_{uuid.uuid4().hex}",
+            completion_window=completion_window,
+            created_at=int(time.time()),
+            endpoint=endpoint,
+            input_file_id=input_file_id,
+            object="batch",
+            status="validating",
+        )
+        return self.save(batch)
+
+    def retrieve(self, batch_id):
+        with open(self.path(batch_id)) as f:
+            batch = Batch.model_validate_json(f.read())
+        if batch.status == "validating":
+            # Report one poll as in progress, then run the whole batch
+            batch.status = "in_progress"
+        elif batch.status == "in_progress":
+            batch = self.run(batch)
+        return self.save(batch)
+
+    def run(self, batch):
+        lines = self.files.content(batch.input_file_id).text.splitlines()
+        outputs = []
+        for line in lines:
+            request = json.loads(line)
+            body = request["body"]
+            # Rough token counts, enough to exercise the cost accounting
+            prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+            completion = {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": self.respond(body),
+                        },
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": 1,
+                    "total_tokens": prompt_tokens + 1,
+                },
+            }
+            outputs.append(
+                {
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": completion},
+                    "error": None,
+                }
+            )
+        batch.output_file_id = self.files.write(outputs)
+        batch.status = "completed"
+        batch.completed_at = int(time.time())
+        return batch
+
+
+class LocalBatchClient:
+    """
+    File-based stand-in for the OpenAI Files and Batch endpoints.
+
+    Batches are stored as json files under `root` and answered by `respond`,
+    which maps a request body to the assistant message content. This lets the
+    submit, poll and join path of the batch mode run without network access.
+    """
+
+    def __init__(self, root, respond=answer_a):
+        self.root = root
+        os.makedirs(os.path.join(root, "files"), exist_ok=True)
+        os.makedirs(os.path.join(root, "batches"), exist_ok=True)
+        self.files = LocalFiles(os.path.join(root, "files"))
+        self.batches = LocalBatches(os.path.join(root, "batches"), self.files, respond)
@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+from evaluate_matrix import load_evaluator
+from mock_server import MockProviderServer
+
+# Models of each provider the benchmark runs as, they only need to be priced
+models = {"openai": "gpt-3.5-turbo-0125", "anthropic": "claude-3-haiku-20240307"}
+
+
+def write_synthetic_dataset(path, n_items=300, seed=0):
+    # Items with the same fields as BertaQA, so prompts have a realistic shape
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(n_items):
+            item = {
+                "id": i,
+                "group": rng.choice(["Euskal gaiak", "Gai orokorrak"]),
+                "category": rng.choice(
+                    ["Geografia eta Historia", "Kirolak", "Zinema eta ikuskizunak"]
+                ),
+                "difficulty": rng.randint(1, 3),
+                "question": f"Synthetic question number {i} about a place?",
+                "candidates": [f"Candidate {i}.{k}" for k in range(3)],
+                "answer": rng.randint(0, 2),
+            }
+            json.dump(item, f)
+            f.write("\n")
+
+
+def run_scenario(
+    evaluator, provider, mode, concurrency, dataset_path, workdir, **options
+):
+    # Fresh limiter state and telemetry, and an empty results directory so
+    # nothing is resumed from the previous scenario
+    evaluator.evaluation.rate_limiters.clear()
+    evaluator.telemetry = evaluator.Telemetry()
+    scenario_dir = os.path.join(workdir, f"{provider}_{mode}_{concurrency}", "run")
+    os.makedirs(scenario_dir)
+
+    cwd = os.getcwd()
+    os.chdir(scenario_dir)
+    started = time.perf_counter()
+    try:
+        # The per-item progress lines would drown the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            evaluator.evaluate_bertaqa(
+                config="eu",
+                model=models[provider],
+                limit=0,
+                mode=mode,
+                concurrency=concurrency,
+                dataset_path=dataset_path,
+                **options,
+            )
+    finally:
+        os.chdir(cwd)
+    seconds = time.perf_counter() - started
+
+    calls = evaluator.telemetry.calls.get(models[provider], [])
+    walls = sorted(s["wall"] for s in calls)
+    items = sum(1 for s in calls if s["status"] == 200)
+    return {
+        "provider": provider,
+        "mode": mode,
+        "concurrency": concurrency if mode != "sync" else 1,
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds,
+        "p50": evaluator.evaluation.percentile(walls, 0.5) if walls else 0.0,
+        "p95": evaluator.evaluation.percentile(walls, 0.95) if walls else 0.0,
+        "retries": sum(s["retries"] for s in calls),
+    }
+
+
+def print_report(results):
+    print(
+        f"{'provider':<10} {'mode':<6} {'conc':>5} {'items':>6} {'seconds':>8} "
+        f"{'items/s':>8} {'p50':>6} {'p95':>6} {'retries':>7}"
+    )
+    for r in results:
+        print(
+            f"{r['provider']:<10} {r['mode']:<6} {r['concurrency']:>5} "
+            f"{r['items']:>6} {r['seconds']:>8.2f} {r['items_per_second']:>8.1f} {r['p50']:>6.3f} "
+            f"{r['p95']:>6.3f} {r['retries']:>7}"
+        )
+
+
+def benchmark(
+    providers=("openai", "anthropic"),
+    modes=("async",),
+    concurrencies=(8, 32, 64),
+    n_items=300,
+    latency="lognormal:0.2,0.5",
+    rate_limit_rate=0.0,
+    error_rate=0.0,
+    rpm=0,
+    output_format="jsonl",
+):
+    server = MockProviderServer(
+        latency=latency,
+        rate_limit_rate=rate_limit_rate,
+        error_rate=error_rate,
+        answer="random",
+        rpm=rpm,
+    ).start()
+    # The clients are created when the evaluators are loaded
+    os.environ["OPENAI_BASE_URL"] = f"{server.url}/v1"
+    os.environ["ANTHROPIC_BASE_URL"] = server.url
+    os.environ["OPENAI_API_KEY"] = "mock"
+    os.environ["ANTHROPIC_API_KEY"] = "mock"
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        dataset_path = os.path.join(workdir, "bertaqa.jsonl")
+        write_synthetic_dataset(dataset_path, n_items=n_items)
+        for provider in providers:
+            evaluator = load_evaluator(provider)
+            for mode in modes:
+                for concurrency in concurrencies if mode != "sync" else [1]:
+                    result = run_scenario(
+                        evaluator,
+                        provider,
+                        mode,
+                        concurrency,
+                        dataset_path,
+                        workdir,
+                        output_format=output_format,
+                    )
+                    results.append(result)
+                    print(
+                        f"{provider} {mode} {concurrency}: "
+                        f"{result['items_per_second']:.1f} items/s"
+                    )
+    server.shutdown()
+
+    print_report(results)
+    return results
+
+
+def main():
+    # Define the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--providers",
+        type=str,
+        nargs="+",
+        default=["openai", "anthropic"],
+        choices=["openai", "anthropic"],
+        help="Evaluators to benchmark",
+    )
+    parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="+",
+        default=["async"],
+        choices=["sync", "async", "triage"],
+        help="Evaluation modes to benchmark",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[8, 32, 64],
+        help="Concurrency levels of the async and triage modes",
+    )
+    parser.add_argument(
+        "--items", type=int, default=300, help="Number of synthetic items"
+    )
+    parser.add_argument(
+        "--latency",
+        type=str,
+        default="lognormal:0.2,0.5",
+        help="Latency distribution of the mock server: fixed:s, uniform:low,high "
+        "or lognormal:median,sigma",
+    )
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with a 429",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with a 500 or 503",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="Requests per minute quota of the mock server, 0 for no quota",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="jsonl",
+        choices=["jsonl", "parquet"],
+        help="Output format of the evaluations",
+    )
+    args = parser.parse_args()
+    benchmark(
+        providers=args.providers,
+        modes=args.modes,
+        concurrencies=args.concurrency,
+        n_items=args.items,
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        rpm=args.rpm,
+        output_format=args.output_format,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.join(root, "results")
+
+providers = ["openai", "anthropic"]
+
+
+def provider_of(model):
+    # A model belongs to the provider whose price registry lists it
+    for provider in providers:
+        with open(os.path.join(root, provider, "pricing.json")) as f:
+            if model in json.load(f):
+                return provider
+    raise ValueError(
+        f"Unknown model {model}, add its prices to openai/pricing.json "
+        "or anthropic/pricing.json"
+    )
+
+
+def load_evaluator(provider):
+    # Both evaluators are scripts that import their own local_batch module, so
+    # load each one with its directory first on the path
+    directory = os.path.join(root, provider)
+    sys.path.insert(0, directory)
+    sys.modules.pop("local_batch", None)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            f"{provider}_evaluate", os.path.join(directory, "evaluate.py")
+        )
+        evaluator = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(evaluator)
+    finally:
+        sys.path.remove(directory)
+        sys.modules.pop("local_batch", None)
+    return evaluator
+
+
+async def run_jobs(jobs, concurrency=32, output_format="jsonl"):
+    # Every model keeps its own requests in flight, so the quotas of all the
+    # providers and models are busy at once. The runs of the same model share
+    # its limit and go one after the other.
+    semaphores = {}
+    with contextlib.ExitStack() as stack:
+        runs = []
+        for evaluator, model, path, ids, requests, options, dead_letter_path in jobs:
+            if model not in semaphores:
+                semaphores[model] = asyncio.Semaphore(concurrency)
+            if output_format == "parquet":
+                writer = evaluator.ParquetResultWriter(path)
+            else:
+                writer = evaluator.ResultWriter(path)
+            stack.enter_context(writer)
+            if dead_letter_path is not None:
+                # Items that keep coming back without content are set aside,
+                # as in evaluate.py
+                dead_letters = evaluator.ResultWriter(dead_letter_path)
+                options = dict(options, dead_letters=stack.enter_context(dead_letters))
+            runs.append(
+                evaluator.evaluate_async(
+                    requests, model, writer, semaphore=semaphores[model], **options
+                )
+            )
+        await asyncio.gather(*runs)
+
+    # The items are written as they are scored, put every output back in
+    # dataset order
+    for evaluator, model, path, ids, requests, options, dead_letter_path in jobs:
+        evaluator.evaluation.sort_results(
+            path, ids, output_format, parquet_writer=evaluator.ParquetResultWriter
+        )
+        if dead_letter_path is None:
+            continue
+        if os.path.getsize(dead_letter_path) == 0:
+            os.remove(dead_letter_path)
+        else:
+            print(
+                f"Some items were set aside in {dead_letter_path}, retry them with "
+                "--retry_dead_letters in anthropic/evaluate.py"
+            )
+
+
+def evaluate_matrix(
+    models,
+    configs=("eu", "en", "en_mt"),
+    shots=(5,),
+    limit=1,
+    start=0,
+    concurrency=32,
+    shot_buckets=0,
+    output_format="jsonl",
+    scoring="text",
+    logit_bias=False,
+):
+    model_providers = {model: provider_of(model) for model in models}
+    evaluators = {
+        provider: load_evaluator(provider)
+        for provider in providers
+        if provider in model_providers.values()
+    }
+    # Both evaluators load the dataset and format the prompts the same way
+    base = next(iter(evaluators.values()))
+
+    jobs = []
+    for config in configs:
+        # Load every config once for all the models
+        print(f"Loading {config} config...")
+        dataset = base.load_bertaqa(config=config)
+
+        for n_shots in shots:
+            # The few-shot examples only depend on the seed, config and item,
+            # so all the models get the ones they would from evaluate.py
+            sampler = base.FewShotSampler(
+                dataset, config=config, shots=n_shots, buckets=shot_buckets
+            )
+            few_shots = base.draw_few_shots(sampler, start=start, limit=limit)
+
+            for model in models:
+                provider = model_providers[model]
+                evaluator = evaluators[provider]
+                os.makedirs(os.path.join(results_dir, model), exist_ok=True)
+                path = os.path.join(
+                    results_dir,
+                    model,
+                    f"bertaqa_{config}_{n_shots}-shot.{output_format}",
+                )
+
+                # Items already in the output file are skipped, as in evaluate.py
+                if output_format == "parquet":
+                    completed = evaluator.load_completed_parquet_ids(path)
+                else:
+                    completed = evaluator.load_completed_ids(path)
+
+                if provider == "openai":
+                    requests = evaluator.build_requests(
+                        sampler,
+                        model,
+                        few_shots,
+                        completed=completed,
+                        scoring=scoring,
+                        logit_bias=logit_bias,
+                    )
+                    options = {}
+                    dead_letter_path = None
+                else:
+                    requests = evaluator.build_requests(
+                        sampler,
+                        model,
+                        few_shots,
+                        completed=completed,
+                        cache_prefix=shot_buckets > 0,
+                    )
+                    # Anthropic has no logprobs, it gets the closest scoring
+                    options = {
+                        "scoring": "constrained" if scoring == "constrained" else "text"
+                    }
+                    dead_letter_path = os.path.splitext(path)[0] + "_dead_letters.jsonl"
+                print(f"{model} {config} {n_shots}-shot: {len(requests)} requests")
+                jobs.append(
+                    (
+                        evaluator,
+                        model,
+                        path,
+                        dataset["id"],
+                        requests,
+                        options,
+                        dead_letter_path,
+                    )
+                )
+
+    asyncio.run(run_jobs(jobs, concurrency=concurrency, output_format=output_format))
+
+    for evaluator in evaluators.values():
+        evaluator.telemetry.summary()
+
+
+def main():
+    # Define the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        required=True,
+        help="OpenAI and Anthropic models to evaluate",
+    )
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=["eu", "en", "en_mt"],
+        choices=["eu", "en", "en_mt"],
+        help="Dataset configs to evaluate on",
+    )
+    parser.add_argument(
+        "--shots",
+        type=int,
+        nargs="+",
+        default=[5],
+        help="Numbers of few-shot examples",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=1, help="Number of examples to evaluate"
+    )
+    parser.add_argument(
+        "--start", type=int, default=0, help="Start index of the examples to evaluate"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=32,
+        help="Maximum number of requests in flight for each model",
+    )
+    parser.add_argument(
+        "--shot_buckets",
+        type=int,
+        default=0,
+        help="Number of fixed few-shot sets shared across items, so requests reuse "
+        "a cached prompt prefix. 0 draws new few-shot examples for every item",
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="jsonl",
+        choices=["jsonl", "parquet"],
+        help="Save the full items as jsonl, or only the id, few-shot indices, "
+        "prediction, usage, latency and cost as a parquet dataset",
+    )
+    parser.add_argument(
+        "--scoring",
+        type=str,
+        default="text",
+        choices=["text", "logprobs", "constrained"],
+        help="Scoring of the models, see openai/evaluate.py. The Anthropic models "
+        "use text scoring unless it is constrained",
+    )
+    parser.add_argument(
+        "--logit_bias",
+        action="store_true",
+        help="Restrict the output of the OpenAI models to the A, B and C tokens "
+        "in logprobs scoring",
+    )
+    args = parser.parse_args()
+    evaluate_matrix(
+        args.models,
+        configs=args.configs,
+        shots=args.shots,
+        limit=args.limit,
+        start=args.start,
+        concurrency=args.concurrency,
+        shot_buckets=args.shot_buckets,
+        output_format=args.output_format,
+        scoring=args.scoring,
+        logit_bias=args.logit_bias,
+    )
+
+
+if __name__ == "__main__":
+    main()
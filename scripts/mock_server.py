@@ -0,0 +1,334 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec):
+    # "fixed:0.2", "uniform:0.1,0.5" or "lognormal:0.3,0.5", the last one
+    # given as the median in seconds and the sigma of the log
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",")] if params else []
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: values[0] * math.exp(values[1] * rng.gauss(0, 1))
+    raise ValueError(
+        "latency must be 'fixed:s', 'uniform:low,high' or 'lognormal:median,sigma'"
+    )
+
+
+def text_length(content):
+    # Content is either a string or a list of text blocks
+    if isinstance(content, str):
+        return len(content)
+    return sum(len(block["text"]) for block in content)
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI chat completions, legacy completions and
+    Anthropic messages endpoints.
+
+    Every request sleeps for a latency drawn from `latency`, then fails with a
+    429 or a 5xx at the given rates, or returns `answer` ("random" draws A, B
+    or C). With `rpm`, requests over the quota get a 429 and every response
+    carries the provider's rate limit headers.
+    """
+
+    daemon_threads = True
+    # Room for every connection of a highly concurrent client
+    request_queue_size = 256
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency="fixed:0.1",
+        rate_limit_rate=0.0,
+        error_rate=0.0,
+        answer="A",
+        rpm=0,
+        seed=0,
+    ):
+        super().__init__(address, MockProviderHandler)
+        self.latency = parse_latency(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.answer = answer
+        self.rpm = rpm
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self):
+        # The shared generator is not thread safe
+        with self.lock:
+            self.requests += 1
+            return self.latency(self.rng), self.rng.random(), self.rng.choice("ABC")
+
+    def quota(self):
+        # Fixed one minute windows, enough to exercise the client limiter
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(0, self.rpm - self.window_requests)
+            reset = self.window_start + 60 - now
+            return self.window_requests > self.rpm, remaining, reset
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        legacy = False
+        if self.path.endswith("/chat/completions"):
+            provider = "openai"
+        elif self.path.endswith("/completions"):
+            # Legacy completions, as served by vLLM and other local servers
+            provider = "openai"
+            legacy = True
+        elif self.path.endswith("/messages"):
+            provider = "anthropic"
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        server = self.server
+        latency, roll, letter = server.draw()
+        time.sleep(latency)
+
+        headers = {}
+        limited = False
+        if server.rpm:
+            limited, remaining, reset = server.quota()
+            headers = rate_limit_headers(provider, server.rpm, remaining, reset)
+        if limited or roll < server.rate_limit_rate:
+            headers["retry-after"] = "1"
+            self.send_json(429, error_body(provider, 429), headers)
+            return
+        if roll < server.rate_limit_rate + server.error_rate:
+            status = 500 if roll < server.rate_limit_rate + server.error_rate / 2 else 503
+            self.send_json(status, error_body(provider, status), headers)
+            return
+
+        answer = letter if server.answer == "random" else server.answer
+        if legacy:
+            self.send_json(200, text_completion(request, answer), headers)
+        elif provider == "openai":
+            self.send_json(200, chat_completion(request, answer), headers)
+        else:
+            self.send_json(200, message(request, answer), headers)
+
+
+def error_body(provider, status):
+    message = "Rate limit reached" if status == 429 else "Internal server error"
+    if provider == "openai":
+        return {"error": {"message": message, "type": "mock_error", "code": status}}
+    kind = "rate_limit_error" if status == 429 else "api_error"
+    return {"type": "error", "error": {"type": kind, "message": message}}
+
+
+def rate_limit_headers(provider, rpm, remaining, reset):
+    if provider == "openai":
+        return {
+            "x-ratelimit-limit-requests": str(rpm),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+    reset_at = datetime.now(timezone.utc) + timedelta(seconds=reset)
+    return {
+        "anthropic-ratelimit-requests-limit": str(rpm),
+        "anthropic-ratelimit-requests-remaining": str(remaining),
+        "anthropic-ratelimit-requests-reset": reset_at.isoformat(),
+    }
+
+
+def chat_completion(request, answer):
+    # Rough token counts, enough to exercise the cost accounting
+    prompt_tokens = sum(text_length(m["content"]) for m in request["messages"]) // 4
+    choice = {
+        "index": 0,
+        "finish_reason": "stop",
+        "message": {"role": "assistant", "content": answer},
+        "logprobs": None,
+    }
+    if request.get("logprobs"):
+        top_logprobs = [
+            {
+                "token": letter,
+                "logprob": 0.0 if letter == answer else -5.0,
+                "bytes": None,
+            }
+            for letter in "ABC"
+        ]
+        choice["logprobs"] = {
+            "content": [
+                {
+                    "token": answer,
+                    "logprob": 0.0,
+                    "bytes": None,
+                    "top_logprobs": top_logprobs,
+                }
+            ]
+        }
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": [choice],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": 1,
+            "total_tokens": prompt_tokens + 1,
+        },
+    }
+
+
+def text_completion(request, answer):
+    # Every prompt of the list gets its own choice, with the logprobs of the
+    # first token in the legacy format
+    prompts = request["prompt"]
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    choices = []
+    for index, prompt in enumerate(prompts):
+        choice = {
+            "index": index,
+            "text": " " + answer,
+            "finish_reason": "length",
+            "logprobs": None,
+        }
+        if request.get("logprobs"):
+            choice["logprobs"] = {
+                "tokens": [" " + answer],
+                "token_logprobs": [0.0],
+                "top_logprobs": [
+                    {f" {letter}": 0.0 if letter == answer else -5.0 for letter in "ABC"}
+                ],
+                "text_offset": [len(prompt)],
+            }
+        choices.append(choice)
+    prompt_tokens = sum(len(prompt) for prompt in prompts) // 4
+    return {
+        "id": f"cmpl-{uuid.uuid4().hex}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": request["model"],
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(prompts),
+            "total_tokens": prompt_tokens + len(prompts),
+        },
+    }
+
+
+def message(request, answer):
+    input_tokens = (
+        text_length(request.get("system", ""))
+        + sum(text_length(m["content"]) for m in request["messages"])
+    ) // 4
+    return {
+        "id": f"msg_{uuid.uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": request["model"],
+        "content": [{"type": "text", "text": answer}],
+        "stop_reason": "max_tokens",
+        "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+    }
+
+
+def main():
+    # Define the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind")
+    parser.add_argument(
+        "--latency",
+        type=str,
+        default="fixed:0.1",
+        help="Latency distribution: fixed:s, uniform:low,high or "
+        "lognormal:median,sigma",
+    )
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with a 429",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with a 500 or 503",
+    )
+    parser.add_argument(
+        "--answer",
+        type=str,
+        default="A",
+        help="Text of every answer, or 'random' for a random letter",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=0,
+        help="Requests per minute before answering with 429s, 0 for no quota",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the draws")
+    args = parser.parse_args()
+    server = MockProviderServer(
+        (args.host, args.port),
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        answer=args.answer,
+        rpm=args.rpm,
+        seed=args.seed,
+    )
+    print(
+        f"Serving on {server.url}, set OPENAI_BASE_URL={server.url}/v1 "
+        f"or ANTHROPIC_BASE_URL={server.url}"
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import random
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, "scripts"))
+sys.path.insert(0, os.path.join(root, "analysis"))
+sys.path.insert(0, os.path.join(root, "common"))
+sys.path.insert(0, os.path.join(root, "translate"))
+
+# The clients are created when the evaluators are loaded, no request is sent
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+
+
+def synthetic_rows(n_items=60, seed=0):
+    # Items with the same fields as BertaQA
+    rng = random.Random(seed)
+    return [
+        {
+            "id": i,
+            "group": ["Euskal gaiak", "Gai orokorrak"][i % 2],
+            "category": ["Geografia eta Historia", "Kirolak", "Zinema"][i % 3],
+            "difficulty": 1 + i % 3,
+            "question": f"Question {i}?",
+            "candidates": [f"Candidate {i}.{k}" for k in range(3)],
+            "answer": rng.randint(0, 2),
+        }
+        for i in range(n_items)
+    ]
+
+
+@pytest.fixture(scope="session")
+def dataset():
+    datasets = pytest.importorskip("datasets")
+    return datasets.Dataset.from_list(synthetic_rows())
+
+
+@pytest.fixture(scope="session", params=["openai", "anthropic"])
+def evaluator(request):
+    from evaluate_matrix import load_evaluator
+
+    return load_evaluator(request.param)
+
+
+@pytest.fixture(scope="session")
+def anthropic_evaluator():
+    from evaluate_matrix import load_evaluator
+
+    return load_evaluator("anthropic")
+
+
+@pytest.fixture(scope="session")
+def openai_evaluator():
+    from evaluate_matrix import load_evaluator
+
+    return load_evaluator("openai")
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+
+def chat_completion(model, content="A"):
+    from openai.types.chat import ChatCompletion
+
+    return ChatCompletion.model_validate(
+        {
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 1, "total_tokens": 101},
+        }
+    )
+
+
+def test_failing_request_holds_back_no_other(
+    openai_evaluator, dataset, tmp_path, monkeypatch
+):
+    evaluator = openai_evaluator
+    model = "gpt-4-0613"
+    sampler = evaluator.FewShotSampler(dataset, shots=2)
+    few_shots = evaluator.draw_few_shots(sampler, limit=40)
+    requests = evaluator.build_requests(sampler, model, few_shots)
+    failing = sampler.questions[0]
+
+    async def completion(stats=None, **kwargs):
+        # The first item fails after the others are done, out of retries
+        if kwargs["messages"][-1]["content"] == failing:
+            await asyncio.sleep(0.05)
+            raise RuntimeError("server error")
+        await asyncio.sleep(0.001 * (len(kwargs["messages"][-1]["content"]) % 7))
+        return chat_completion(model)
+
+    monkeypatch.setattr(evaluator, "async_completion_with_backoff", completion)
+    path = str(tmp_path / "results.jsonl")
+    with evaluator.ResultWriter(path) as writer:
+        asyncio.run(evaluator.evaluate_async(requests, model, writer, concurrency=4))
+
+    results = [json.loads(line) for line in open(path)]
+    assert sorted(result["position"] for result in results) == list(range(1, 40))
+
+    # Sorting at the end of the run restores the dataset order
+    evaluator.evaluation.sort_results(path, dataset["id"])
+    results = [json.loads(line) for line in open(path)]
+    assert [result["id"] for result in results] == dataset["id"][1:40]
+    assert [result["position"] for result in results] == list(range(1, 40))
+
+
+def test_budget_holds_across_resumed_runs(
+    openai_evaluator, dataset, tmp_path, monkeypatch
+):
+    evaluator = openai_evaluator
+    model = "gpt-4-0613"
+    sent = []
+
+    async def completion(stats=None, **kwargs):
+        sent.append(kwargs)
+        return chat_completion(model)
+
+    monkeypatch.setattr(evaluator, "async_completion_with_backoff", completion)
+    sampler = evaluator.FewShotSampler(dataset, shots=2)
+    path = str(tmp_path / "results.jsonl")
+    # An earlier run spent the whole budget on the first items
+    with open(path, "w") as f:
+        for i in range(4):
+            item = {"id": dataset["id"][i], "correct": True, "cost": 0.25}
+            f.write(json.dumps(item) + "\n")
+
+    completed = evaluator.load_completed_ids(path)
+    few_shots = evaluator.draw_few_shots(sampler, limit=10)
+    requests = evaluator.build_requests(sampler, model, few_shots, completed=completed)
+    assert evaluator.load_spent(path) == 1.0
+    with evaluator.ResultWriter(path) as writer:
+        asyncio.run(
+            evaluator.evaluate_async(
+                requests,
+                model,
+                writer,
+                max_cost=1.0,
+                spent=evaluator.load_spent(path),
+            )
+        )
+    assert sent == []
+    assert len(evaluator.load_completed_ids(path)) == 4
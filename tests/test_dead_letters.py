@@ -0,0 +1,231 @@
+import asyncio
+import json
+
+import pytest
+
+
+def test_malformed_batch_result_keeps_run_cost(anthropic_evaluator, dataset, tmp_path):
+    evaluator = anthropic_evaluator
+    model = "claude-3-haiku-20240307"
+    sampler = evaluator.FewShotSampler(dataset, shots=2)
+    few_shots = evaluator.draw_few_shots(sampler, limit=6)
+    requests = evaluator.build_requests(sampler, model, few_shots)
+    malformed = requests[2][1]["question"]
+
+    def respond(params):
+        # One result comes back without content
+        return None if malformed in params["messages"][-1]["content"] else "A"
+
+    path = tmp_path / "results.jsonl"
+    with evaluator.ResultWriter(str(path)) as writer, evaluator.ResultWriter(
+        str(tmp_path / "dead_letters.jsonl")
+    ) as dead_letters:
+        cost = evaluator.evaluate_batch(
+            requests,
+            model,
+            writer,
+            evaluator.LocalBatchClient(str(tmp_path / "local"), respond=respond),
+            str(tmp_path / "batches"),
+            poll_interval=0,
+            dead_letters=dead_letters,
+        )
+
+    results = [json.loads(line) for line in open(path)]
+    letters = [json.loads(line) for line in open(tmp_path / "dead_letters.jsonl")]
+    assert len(results) == 5
+    assert [letter["id"] for letter in letters] == [requests[2][1]["id"]]
+    # The malformed result is paid for and adds to the total, not replaces it
+    assert letters[0]["cost"] > 0
+    expected = sum(result["cost"] for result in results) + letters[0]["cost"]
+    assert abs(cost - expected) < 1e-6
+
+
+class FakeCompletions:
+    # Answers every packed prompt with "A", except the malformed ones, whose
+    # choices come back without logprobs
+    def __init__(self, malformed, usage=True):
+        self.malformed = malformed
+        self.usage = usage
+        self.with_raw_response = self
+
+    async def create(self, model, prompt, **kwargs):
+        from openai.types import Completion
+
+        choices = []
+        for index, text in enumerate(prompt):
+            logprobs = {"tokens": ["A"], "top_logprobs": [{"A": -0.1, "B": -2.5}]}
+            if text.endswith(self.malformed):
+                logprobs = None
+            choices.append(
+                {"index": index, "text": "A", "logprobs": logprobs, "finish_reason": "length"}
+            )
+        completion = Completion.model_validate(
+            {
+                "id": "cmpl-test",
+                "object": "text_completion",
+                "created": 0,
+                "model": model,
+                "choices": choices,
+                "usage": (
+                    {
+                        "prompt_tokens": 10 * len(prompt),
+                        "completion_tokens": len(prompt),
+                        "total_tokens": 11 * len(prompt),
+                    }
+                    if self.usage
+                    else None
+                ),
+            }
+        )
+        return FakeRawResponse(completion)
+
+
+class FakeRawResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, completion):
+        self.completion = completion
+
+    def parse(self):
+        return self.completion
+
+
+class FakeClient:
+    def __init__(self, malformed, usage=True):
+        self.completions = FakeCompletions(malformed, usage=usage)
+
+
+@pytest.mark.parametrize("usage", [True, False])
+def test_choice_without_logprobs_is_set_aside(
+    openai_evaluator, dataset, tmp_path, usage
+):
+    evaluator = openai_evaluator
+    model = "local-model"
+    sampler = evaluator.FewShotSampler(dataset, shots=2)
+    few_shots = evaluator.draw_few_shots(sampler, limit=6)
+    requests = evaluator.build_requests(sampler, model, few_shots)
+    # The question of the third item ends its prompt
+    malformed = sampler.questions[requests[2][0]]
+
+    path = tmp_path / "results.jsonl"
+    with evaluator.ResultWriter(str(path)) as writer, evaluator.ResultWriter(
+        str(tmp_path / "dead_letters.jsonl")
+    ) as dead_letters:
+        asyncio.run(
+            evaluator.evaluate_completions(
+                requests,
+                model,
+                writer,
+                FakeClient(malformed, usage=usage),
+                prompts_per_request=4,
+                dead_letters=dead_letters,
+            )
+        )
+
+    results = [json.loads(line) for line in open(path)]
+    letters = [json.loads(line) for line in open(tmp_path / "dead_letters.jsonl")]
+    assert len(results) == 5
+    assert all(result["prediction"] == "A" for result in results)
+    assert [letter["id"] for letter in letters] == [requests[2][1]["id"]]
+    assert letters[0]["error"] == "IndexError: choice without logprobs"
+
+
+def message(model, text):
+    from anthropic.types import Message
+
+    return Message.model_validate(
+        {
+            "id": "msg-test",
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [] if text is None else [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 10000, "output_tokens": 1},
+        }
+    )
+
+
+def test_retry_keeps_the_items_it_never_sent(
+    anthropic_evaluator, tmp_path, monkeypatch
+):
+    from conftest import synthetic_rows
+
+    evaluator = anthropic_evaluator
+    model = "claude-3-haiku-20240307"
+    dataset_path = tmp_path / "bertaqa.jsonl"
+    with open(dataset_path, "w") as f:
+        for row in synthetic_rows(n_items=10):
+            f.write(json.dumps(row) + "\n")
+    (tmp_path / "run").mkdir()
+    monkeypatch.chdir(tmp_path / "run")
+
+    malformed = {f"Question {i}?" for i in range(6)}
+
+    def completion(stats=None, **kwargs):
+        question = kwargs["messages"][-1]["content"]
+        if any(q in question.split("\n")[0] for q in malformed):
+            return message(model, None)
+        return message(model, "A")
+
+    async def async_completion(stats=None, **kwargs):
+        return completion(stats=stats, **kwargs)
+
+    monkeypatch.setattr(evaluator, "completion_with_backoff", completion)
+    monkeypatch.setattr(evaluator, "async_completion_with_backoff", async_completion)
+    run = dict(
+        config="eu", model=model, shots=2, limit=0, dataset_path=str(dataset_path)
+    )
+    evaluator.evaluate_bertaqa(mode="async", **run)
+
+    results = tmp_path / "results" / model
+    dead_letter_path = results / "bertaqa_eu_2-shot_dead_letters.jsonl"
+    letters = [json.loads(line) for line in open(dead_letter_path)]
+    assert sorted(letter["position"] for letter in letters) == list(range(6))
+
+    # The retry only has the budget for two items, the other four keep their
+    # record and cost
+    malformed.clear()
+    spent = evaluator.load_spent(str(results / "bertaqa_eu_2-shot.jsonl"))
+    evaluator.evaluate_bertaqa(
+        mode="sync", retry_dead_letters=True, max_cost=spent + 0.005, **run
+    )
+    output = [json.loads(line) for line in open(results / "bertaqa_eu_2-shot.jsonl")]
+    kept = [json.loads(line) for line in open(dead_letter_path)]
+    assert len(output) == 6
+    assert [result["position"] for result in output] == sorted(
+        result["position"] for result in output
+    )
+    assert len(kept) == 4
+    ids = {letter["id"] for letter in kept} | {result["id"] for result in output}
+    assert ids == set(range(10))
+    assert all(letter["cost"] > 0 for letter in kept)
+
+
+def test_matrix_sets_aside_malformed_items(
+    anthropic_evaluator, dataset, tmp_path, monkeypatch
+):
+    from evaluate_matrix import run_jobs
+
+    evaluator = anthropic_evaluator
+    model = "claude-3-haiku-20240307"
+    sampler = evaluator.FewShotSampler(dataset, shots=2)
+    few_shots = evaluator.draw_few_shots(sampler, limit=6)
+    requests = evaluator.build_requests(sampler, model, few_shots)
+    malformed = sampler.questions[requests[2][0]]
+
+    async def completion(stats=None, **kwargs):
+        text = None if kwargs["messages"][-1]["content"] == malformed else "A"
+        return message(model, text)
+
+    monkeypatch.setattr(evaluator, "async_completion_with_backoff", completion)
+    path = str(tmp_path / "results.jsonl")
+    dead_letter_path = str(tmp_path / "results_dead_letters.jsonl")
+    job = (evaluator, model, path, dataset["id"], requests, {}, dead_letter_path)
+    asyncio.run(run_jobs([job]))
+
+    assert len(open(path).readlines()) == 5
+    letters = [json.loads(line) for line in open(dead_letter_path)]
+    assert [letter["id"] for letter in letters] == [requests[2][1]["id"]]
@@ -0,0 +1,46 @@
+from evaluation import FewShotSampler
+
+
+def test_few_shots_exclude_the_target(dataset):
+    sampler = FewShotSampler(dataset, shots=5)
+    for i in range(len(sampler.rows)):
+        few_shot_indices = sampler.sample(i)
+        assert len(few_shot_indices) == 5
+        assert len(set(few_shot_indices)) == 5
+        assert i not in few_shot_indices
+        assert all(0 <= j < len(sampler.rows) for j in few_shot_indices)
+
+
+def test_few_shots_reach_the_first_and_last_rows(dataset):
+    # The skip over the target index must not leave any row out
+    sampler = FewShotSampler(dataset, shots=5)
+    drawn = {j for i in range(len(sampler.rows)) for j in sampler.sample(i)}
+    assert {0, len(sampler.rows) - 1} <= drawn
+
+
+def test_bucketed_few_shots_exclude_the_target(dataset):
+    sampler = FewShotSampler(dataset, shots=5, buckets=3)
+    sets = {tuple(few_shot_set) for few_shot_set in sampler.fixed}
+    for i in range(len(sampler.rows)):
+        few_shot_indices = sampler.sample(i)
+        assert i not in few_shot_indices
+        assert tuple(few_shot_indices) in sets
+
+
+def test_few_shots_only_depend_on_the_item(dataset):
+    sampler = FewShotSampler(dataset, shots=5)
+    # The same draws in any order, range or shard, and in a new sampler
+    draws = {i: sampler.sample(i) for i in range(len(sampler.rows))}
+    for i in reversed(range(len(sampler.rows))):
+        assert sampler.sample(i) == draws[i]
+    again = FewShotSampler(dataset, shots=5)
+    assert all(again.sample(i) == draws[i] for i in draws)
+
+
+def test_few_shots_change_with_the_seed_and_config(dataset):
+    sampler = FewShotSampler(dataset, shots=5)
+    for other in [
+        FewShotSampler(dataset, shots=5, seed=7),
+        FewShotSampler(dataset, config="en", shots=5),
+    ]:
+        assert any(other.sample(i) != sampler.sample(i) for i in range(len(sampler.rows)))
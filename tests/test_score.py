@@ -0,0 +1,47 @@
+import json
+import math
+import statistics
+
+import pytest
+from score import Accuracy, summarize
+
+from conftest import synthetic_rows
+
+
+def test_stderr_matches_lm_eval():
+    # lm_eval reports the sample standard deviation over the square root of n
+    accuracy = Accuracy()
+    outcomes = [1, 1, 1, 0]
+    for correct in outcomes:
+        accuracy.add(correct)
+    assert accuracy.acc == 0.75
+    assert accuracy.stderr == pytest.approx(0.25)
+    assert accuracy.stderr == pytest.approx(
+        statistics.stdev(outcomes) / math.sqrt(len(outcomes))
+    )
+
+
+def test_summarize_scores_every_subset(tmp_path):
+    path = tmp_path / "gpt-4-0613" / "bertaqa_eu_5-shot.jsonl"
+    path.parent.mkdir()
+    rows = synthetic_rows()
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(dict(row, correct=row["answer"] == 0, cost=0.0)) + "\n")
+        # A last line cut short by a crash is left out
+        f.write('{"id": 60, "correct": tr')
+
+    summary = summarize(str(path))
+
+    outcomes = [row["answer"] == 0 for row in rows]
+    overall = summary["results"]["bertaqa_eu"]
+    assert summary["n-samples"]["bertaqa_eu"]["effective"] == len(rows)
+    assert summary["n-shot"] == {"bertaqa_eu": 5}
+    assert summary["config"] == {"model": "gpt-4-0613"}
+    assert overall["acc,none"] == pytest.approx(statistics.mean(outcomes))
+    assert overall["acc_stderr,none"] == pytest.approx(
+        statistics.stdev(outcomes) / math.sqrt(len(outcomes))
+    )
+    local = summary["results"]["bertaqa_eu_group_local"]
+    local_outcomes = outcomes[::2]
+    assert local["acc,none"] == pytest.approx(statistics.mean(local_outcomes))
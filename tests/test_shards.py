@@ -0,0 +1,45 @@
+import json
+
+import pytest
+from evaluation import ResultWriter, merge_shards, shard_path, shard_range
+
+
+@pytest.mark.parametrize("start,limit", [(0, 0), (7, 0), (7, 20), (0, 1000)])
+@pytest.mark.parametrize("num_shards", [1, 3, 4])
+def test_shards_cover_every_index_once(start, limit, num_shards):
+    n_rows = 50
+    indices = [
+        i
+        for shard_id in range(num_shards)
+        for i in shard_range(n_rows, start, limit, num_shards, shard_id)
+    ]
+    end = n_rows if limit == 0 else min(n_rows, start + limit)
+    assert sorted(indices) == list(range(start, end))
+
+
+def test_shard_id_out_of_range():
+    with pytest.raises(ValueError):
+        shard_range(50, num_shards=2, shard_id=2)
+
+
+def test_merge_restores_dataset_order(tmp_path):
+    ids = [f"item-{i}" for i in range(10)]
+    path = str(tmp_path / "results.jsonl")
+    num_shards = 3
+    for shard_id in range(num_shards):
+        # Shards finish their items in any order, and one of them is missing
+        indices = list(shard_range(len(ids), 0, 0, num_shards, shard_id))
+        with ResultWriter(shard_path(path, num_shards, shard_id)) as writer:
+            for i in reversed(indices):
+                if i != 4:
+                    writer.write({"id": ids[i], "correct": i % 2 == 0, "cost": 0.5})
+
+    summary = merge_shards(path, ids, num_shards)
+
+    merged = [json.loads(line)["id"] for line in open(path)]
+    assert merged == [id for i, id in enumerate(ids) if i != 4]
+    assert summary["missing_ids"] == ["item-4"]
+    assert summary["cost"] == 4.5
+    # Merging again keeps a single copy of every item
+    merge_shards(path, ids, num_shards)
+    assert [json.loads(line)["id"] for line in open(path)] == merged
@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from dataset import deduplicate, expand_duplicates, restore_order, sort_by_length  # noqa: E402
+
+sentences = ["Kaixo.", "Zer moduz zaude gaur?", "Kaixo.", "Bai", "Zer moduz zaude gaur?", "Ez"]
+
+
+def fake_translate(sentences, num_return_sequences):
+    return [f"{sentence} ({k})" for sentence in sentences for k in range(num_return_sequences)]
+
+
+@pytest.mark.parametrize("num_return_sequences", [1, 3])
+def test_restore_order_undoes_sort_by_length(num_return_sequences):
+    sorted_sentences, order = sort_by_length(sentences)
+    assert [len(sentence) for sentence in sorted_sentences] == sorted(
+        map(len, sentences), reverse=True
+    )
+    translations = fake_translate(sorted_sentences, num_return_sequences)
+    restored = restore_order(translations, order, num_return_sequences)
+    assert restored == fake_translate(sentences, num_return_sequences)
+
+
+@pytest.mark.parametrize("num_return_sequences", [1, 3])
+def test_expand_duplicates_undoes_deduplicate(num_return_sequences):
+    unique, index = deduplicate(sentences)
+    assert unique == ["Kaixo.", "Zer moduz zaude gaur?", "Bai", "Ez"]
+    translations = fake_translate(unique, num_return_sequences)
+    expanded = expand_duplicates(translations, index, num_return_sequences)
+    assert expanded == fake_translate(sentences, num_return_sequences)
+
+
+def test_sorted_unique_sentences_round_trip():
+    # The drivers deduplicate first and sort the unique sentences
+    unique, index = deduplicate(sentences)
+    sorted_sentences, order = sort_by_length(unique)
+    translations = restore_order(fake_translate(sorted_sentences, 2), order, 2)
+    assert expand_duplicates(translations, index, 2) == fake_translate(sentences, 2)
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("accelerate")
+
+from translation_memory import TranslationMemory  # noqa: E402
+
+translate_args = {
+    "model_name": "facebook/nllb-200-distilled-600M",
+    "source_lang": "eus_Latn",
+    "target_lang": "eng_Latn",
+    "precision": "bf16",
+    "max_length": 256,
+    "max_new_tokens": 256,
+    "num_beams": 4,
+    "num_return_sequences": 2,
+    "do_sample": False,
+    "keep_special_tokens": False,
+    "eos_token": None,
+    "temperature": 0.8,
+    "top_k": 50,
+    "top_p": 1.0,
+    "batch_size": 8,
+}
+
+
+class FakeTranslator:
+    def __init__(self):
+        self.sentences = []
+
+    def __call__(self, sentences_list, return_output, **kwargs):
+        self.sentences.extend(sentences_list)
+        return [
+            f"{sentence} [{kwargs['model_name']} {k}]"
+            for sentence in sentences_list
+            for k in range(kwargs["num_return_sequences"])
+        ]
+
+
+def test_memory_hits_and_misses(tmp_path):
+    translator = FakeTranslator()
+    memory = TranslationMemory(str(tmp_path / "memory.sqlite"))
+    first = memory.translate(translator, ["Kaixo.", "Bai"], translate_args)
+    assert translator.sentences == ["Kaixo.", "Bai"]
+    assert (memory.hits, memory.misses) == (0, 2)
+
+    # A new memory on the same file, as in a later run
+    memory = TranslationMemory(str(tmp_path / "memory.sqlite"))
+    second = memory.translate(translator, ["Ez", "Kaixo.", "Bai"], translate_args)
+    assert translator.sentences == ["Kaixo.", "Bai", "Ez"]
+    assert (memory.hits, memory.misses) == (2, 1)
+    assert second[2:] == first
+    assert len(second) == 3 * translate_args["num_return_sequences"]
+
+
+def test_settings_change_the_key():
+    settings = TranslationMemory.settings(translate_args)
+    for key, value in [("model_name", "google/madlad400-3b-mt"), ("num_beams", 1)]:
+        assert TranslationMemory.settings({**translate_args, key: value}) != settings
+    # Arguments that leave the translations as they are share the key
+    assert TranslationMemory.settings({**translate_args, "batch_size": 32}) == settings
+    assert TranslationMemory.settings({**translate_args, "temperature": 0.2}) == settings
+    sampling = {**translate_args, "do_sample": True}
+    assert TranslationMemory.settings({**sampling, "temperature": 0.2}) != (
+        TranslationMemory.settings(sampling)
+    )
+
+
+def test_other_settings_miss(tmp_path):
+    translator = FakeTranslator()
+    memory = TranslationMemory(str(tmp_path / "memory.sqlite"))
+    memory.translate(translator, ["Kaixo."], translate_args)
+    other = {**translate_args, "model_name": "google/madlad400-3b-mt"}
+    translations = memory.translate(translator, ["Kaixo."], other)
+    assert translator.sentences == ["Kaixo.", "Kaixo."]
+    assert translations[0] == "Kaixo. [google/madlad400-3b-mt 0]"
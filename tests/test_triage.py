@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+
+def test_triage_stops_once_the_interval_is_narrow(
+    openai_evaluator, dataset, tmp_path, monkeypatch
+):
+    from openai.types.chat import ChatCompletion
+
+    evaluator = openai_evaluator
+    model = "gpt-4-0613"
+    sent = []
+
+    async def completion(stats=None, **kwargs):
+        # Always right, so the interval narrows as fast as it can
+        sent.append(kwargs)
+        await asyncio.sleep(0)
+        return ChatCompletion.model_validate(
+            {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "created": 0,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "A"},
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 1, "total_tokens": 101},
+            }
+        )
+
+    monkeypatch.setattr(evaluator, "async_completion_with_backoff", completion)
+    rows = [dict(row, answer=0) for row in dataset]
+    sampler = evaluator.FewShotSampler(type(dataset).from_list(rows), shots=2)
+    few_shots = evaluator.draw_few_shots(sampler, limit=0)
+    requests = evaluator.build_requests(sampler, model, few_shots)
+
+    path = tmp_path / "results.jsonl"
+    with evaluator.ResultWriter(str(path)) as writer:
+        asyncio.run(
+            evaluator.evaluate_triage(
+                requests,
+                model,
+                writer,
+                target_halfwidth=0.1,
+                min_items=10,
+                concurrency=4,
+            )
+        )
+
+    # Number of right answers after which the interval is narrow enough
+    needed = next(
+        n
+        for n in range(10, len(requests))
+        if (1 - evaluator.wilson_interval(n, n, 1.959964)[0]) / 2 <= 0.1
+    )
+    results = [json.loads(line) for line in open(path)]
+    # The interval is checked as every result arrives, so at most the
+    # requests in flight are sent after it is narrow enough
+    assert needed <= len(results) < needed + 4
+    assert len(sent) == len(results)
+    assert len({result["id"] for result in results}) == len(results)
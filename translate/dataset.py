@@ -15,6 +15,83 @@ def count_lines(input_list: List[str]) -> int:
     return len(input_list)
 
 
+def sort_by_length(sentences: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Sorts sentences from the longest to the shortest, so that every batch holds
+    sentences of similar length and needs little padding. The longest batch
+    comes first, so an OOM error shows up before any work is lost.
+
+    Args:
+        sentences (List[str]): List of sentences.
+
+    Returns:
+        Tuple[List[str], List[int]]: Sorted sentences and the original index of each one.
+    """
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+    return [sentences[i] for i in order], order
+
+
+def restore_order(
+    translations: List[str], order: List[int], num_return_sequences: int = 1
+) -> List[str]:
+    """
+    Puts the translations of sentences sorted by sort_by_length back in the original order.
+
+    Args:
+        translations (List[str]): Translations of the sorted sentences, num_return_sequences for each one.
+        order (List[int]): Original index of each sorted sentence, as returned by sort_by_length.
+        num_return_sequences (int, optional): Number of translations of each sentence. Defaults to 1.
+
+    Returns:
+        List[str]: Translations in the original order of the sentences.
+    """
+    restored = [None] * len(translations)
+    for position, index in enumerate(order):
+        start = index * num_return_sequences
+        restored[start : start + num_return_sequences] = translations[
+            position * num_return_sequences : (position + 1) * num_return_sequences
+        ]
+    return restored
+
+
+def deduplicate(sentences: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    Keeps the first copy of every sentence, so that repeated sentences are translated only once.
+
+    Args:
+        sentences (List[str]): List of sentences.
+
+    Returns:
+        Tuple[List[str], List[int]]: Unique sentences, and the index in them of each original sentence.
+    """
+    positions = {}
+    index = [positions.setdefault(sentence, len(positions)) for sentence in sentences]
+    return list(positions), index
+
+
+def expand_duplicates(
+    translations: List[str], index: List[int], num_return_sequences: int = 1
+) -> List[str]:
+    """
+    Copies the translations of the unique sentences back to every original sentence.
+
+    Args:
+        translations (List[str]): Translations of the unique sentences, num_return_sequences for each one.
+        index (List[int]): Index in the unique sentences of each original sentence, as returned by deduplicate.
+        num_return_sequences (int, optional): Number of translations of each sentence. Defaults to 1.
+
+    Returns:
+        List[str]: Translations of the original sentences.
+    """
+    return [
+        translation
+        for i in index
+        for translation in translations[
+            i * num_return_sequences : (i + 1) * num_return_sequences
+        ]
+    ]
+
+
 class DatasetReader(IterableDataset):
     def __init__(self, sentences: List[str], tokenizer, max_length: int = 128):
         """
@@ -5,6 +5,8 @@ import os
 import argparse
 import pandas as pd
 from dataset_configs import dataset_configs
+from dataset import deduplicate, expand_duplicates
+from translation_memory import TranslationMemory
 from typing import Dict, Any, List
 import json
 
@@ -190,6 +192,8 @@ def translate_texts(
     translate_args: Dict[str, Any],
     dataset_args: Dict[str, Any],
     flatten: List[int],
+    memory: TranslationMemory = None,
+    prompts: Dict[str, str] = None,
 ) -> None:
     """
     Translate the texts.
@@ -199,23 +203,45 @@ def translate_texts(
     - texts: A dictionary containing the texts to be translated.
     - translate_args: A dictionary containing the translation configurations.
     - dataset_args: A dictionary containing the dataset configurations.
+    - flatten: Number of candidates of each item, to unflatten their translations.
+    - memory: Translation memory to look the sentences up in, or None to translate all of them.
+    - prompts: Few-shot prompt of each config to encode once and reuse for every sentence, or None.
 
     Returns:
     - None
     """
+    # The model is loaded once for every field of every config
+    session = translate_few_shot.TranslationSession(
+        translate_args["model_name"],
+        translate_args["cache_dir"],
+        translate_args["precision"],
+    )
     translations = {}
     for config in dataset_args["dataset_configs"]:
         translations[config] = dataset[config].to_dict()
         translate_args["source_lang"] = dataset_args["lang_codes"][config]
+        if prompts is not None:
+            translate_args["prompt"] = prompts[config]
         print(f"Translating from {config}")
         for field in dataset_args["dataset_fields"]:
-            translations[config][field] = translate_few_shot.main(
-                sentences_list=texts[config][field],
-                return_output=True,
-                **translate_args,
+            # Repeated sentences, common among the candidates, are translated once
+            sentences, index = deduplicate(texts[config][field])
+            print(f"{len(sentences)} unique sentences out of {len(index)}")
+            if memory is None:
+                unique_translations = session.translate(
+                    sentences_list=sentences,
+                    return_output=True,
+                    **translate_args,
+                )
+            else:
+                unique_translations = memory.translate(
+                    session.translate, sentences, translate_args
+                )
+            unique_translations = extract_translations(
+                unique_translations, sentences, translate_args
             )
-            translations[config][field] = extract_translations(
-                translations[config][field], texts[config][field], translate_args
+            translations[config][field] = expand_duplicates(
+                unique_translations, index, translate_args["num_return_sequences"]
             )
             # if field is a list of strings, we unflatten it with the same length as the original
             if field == "candidates":
@@ -277,13 +303,20 @@ def save_file(
         raise ValueError("Unknown file format")
 
 
-def main(translate_args: Dict[str, Any], dataset_args: Dict[str, Any]) -> None:
+def main(
+    translate_args: Dict[str, Any],
+    dataset_args: Dict[str, Any],
+    memory_path: str = None,
+    cache_prompt: bool = False,
+) -> None:
     """
     Main function to translate the dataset.
 
     Args:
     - translate_args: A dictionary containing the translation configurations.
     - dataset_args: A dictionary containing the dataset configurations.
+    - memory_path: Path of the translation memory, or None to not use one.
+    - cache_prompt: Encode the few-shot prompt of each config once and generate from its keys and values.
 
     Returns:
     - None
@@ -298,7 +331,18 @@ def main(translate_args: Dict[str, Any], dataset_args: Dict[str, Any]) -> None:
         texts, prompts, translate_args=translate_args
     )
     # print(texts_with_prompts)
-    translate_texts(dataset, texts_with_prompts, translate_args, dataset_args, flatten)
+    memory = None if memory_path is None else TranslationMemory(memory_path)
+    translate_texts(
+        dataset,
+        texts_with_prompts,
+        translate_args,
+        dataset_args,
+        flatten,
+        memory,
+        prompts if cache_prompt else None,
+    )
+    if memory is not None:
+        memory.report()
 
 
 if __name__ == "__main__":
@@ -412,6 +456,21 @@ if __name__ == "__main__":
         help="Keep special tokens in the decoded text.",
     )
 
+    parser.add_argument(
+        "--translation_memory",
+        type=str,
+        default=None,
+        help="SQLite file with the translations of previous runs. Sentences already translated "
+        "with the same model and generation arguments are read from it instead of translated.",
+    )
+
+    parser.add_argument(
+        "--cache_prompt",
+        action="store_true",
+        help="Encode the few-shot prompt of each config once and generate every batch from its "
+        "cached keys and values. Needs num_beams and num_return_sequences to be 1.",
+    )
+
     parser.add_argument(
         "--eos_token",
         type=str,
@@ -441,4 +500,9 @@ if __name__ == "__main__":
 
     dataset_args = dataset_configs[args.dataset]
 
-    main(translate_args, dataset_args)
+    main(
+        translate_args,
+        dataset_args,
+        memory_path=args.translation_memory,
+        cache_prompt=args.cache_prompt,
+    )
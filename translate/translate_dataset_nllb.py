@@ -5,6 +5,8 @@ import os
 import argparse
 import pandas as pd
 from dataset_configs import dataset_configs
+from dataset import deduplicate, expand_duplicates
+from translation_memory import TranslationMemory
 
 
 def get_dataset(dataset_args):
@@ -24,7 +26,13 @@ def get_texts(dataset, dataset_args):
     return texts
 
 
-def translate_texts(dataset, texts, translate_args, dataset_args):
+def translate_texts(dataset, texts, translate_args, dataset_args, memory=None):
+    # The model is loaded once for every field of every config
+    session = translate.TranslationSession(
+        translate_args["model_name"],
+        translate_args["cache_dir"],
+        translate_args["precision"],
+    )
     translations = {}
     for config in dataset_args["dataset_configs"]:
         translations[config] = dataset[config].to_dict()
@@ -41,10 +49,23 @@ def translate_texts(dataset, texts, translate_args, dataset_args):
                     for sentence in sentences
                 ]
 
-            translations[config][field] = translate.main(
-                sentences_list=texts[config][field],
-                return_output=True,
-                **translate_args,
+            # Repeated sentences, common among the candidates, are translated once
+            sentences, index = deduplicate(texts[config][field])
+            print(f"{len(sentences)} unique sentences out of {len(index)}")
+            if memory is None:
+                unique_translations = session.translate(
+                    sentences_list=sentences,
+                    return_output=True,
+                    **translate_args,
+                )
+            else:
+                unique_translations = memory.translate(
+                    session.translate, sentences, translate_args
+                )
+            translations[config][field] = expand_duplicates(
+                unique_translations,
+                index,
+                translate_args["num_return_sequences"],
             )
             # if field is a list of strings, we unflatten it with the same length as the original
             if flatten:
@@ -73,10 +94,13 @@ def save_file(translations, config, translate_args, dataset_args):
         raise ValueError("Unknown file format")
 
 
-def main(translate_args, dataset_args):
+def main(translate_args, dataset_args, memory_path=None):
     dataset = get_dataset(dataset_args)
     texts = get_texts(dataset, dataset_args)
-    translate_texts(dataset, texts, translate_args, dataset_args)
+    memory = None if memory_path is None else TranslationMemory(memory_path)
+    translate_texts(dataset, texts, translate_args, dataset_args, memory)
+    if memory is not None:
+        memory.report()
 
 
 if __name__ == "__main__":
@@ -182,6 +206,14 @@ if __name__ == "__main__":
         help="Keep special tokens in the decoded text.",
     )
 
+    parser.add_argument(
+        "--translation_memory",
+        type=str,
+        default=None,
+        help="SQLite file with the translations of previous runs. Sentences already translated "
+        "with the same model and generation arguments are read from it instead of translated.",
+    )
+
     args = parser.parse_args()
 
     translate_args = dict(
@@ -202,4 +234,4 @@ if __name__ == "__main__":
 
     dataset_args = dataset_configs[args.dataset]
 
-    main(translate_args, dataset_args)
+    main(translate_args, dataset_args, memory_path=args.translation_memory)
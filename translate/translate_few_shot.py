@@ -12,9 +12,10 @@ from transformers import (
     AutoTokenizer,
     PreTrainedTokenizerBase,
     DataCollatorForSeq2Seq,
+    DynamicCache,
 )
 
-from dataset import DatasetReader, count_lines
+from dataset import DatasetReader, restore_order, sort_by_length
 
 from accelerate import Accelerator, DistributedType, find_executable_batch_size
 
@@ -29,6 +30,7 @@ def get_dataloader(
     tokenizer: PreTrainedTokenizerBase,
     batch_size: int,
     max_length: int,
+    prefix_ids: list = None,
 ) -> DataLoader:
     dataset = DatasetReader(translate_data, tokenizer, max_length)
     if accelerator.distributed_type == DistributedType.TPU:
@@ -49,6 +51,21 @@ def get_dataloader(
             return_tensors="pt",
         )
 
+    if prefix_ids is not None:
+        pad_collator = data_collator
+
+        def data_collator(features):
+            # The prompt comes from its cached keys and values, only the rest of
+            # each sentence is padded and batched
+            for feature in features:
+                if feature["input_ids"][: len(prefix_ids)] != prefix_ids:
+                    raise ValueError(
+                        "A sentence does not start with the tokens of the cached prompt"
+                    )
+                feature["input_ids"] = feature["input_ids"][len(prefix_ids) :]
+                feature["attention_mask"] = feature["attention_mask"][len(prefix_ids) :]
+            return pad_collator(features)
+
     return DataLoader(
         dataset,
         batch_size=batch_size,
@@ -57,6 +74,111 @@ def get_dataloader(
     )
 
 
+def add_prompt(batch: dict, prefix_ids: list, prefix_cache: tuple) -> dict:
+    """
+    Puts the tokens of the prompt back in front of a batch of sentences, with their
+    cached keys and values, so that generate only encodes the sentences.
+
+    Args:
+        batch (dict): Batch of sentences without the prompt, padded on the left.
+        prefix_ids (list): Tokens of the prompt.
+        prefix_cache (tuple): Keys and values of the prompt for each layer, for a batch of one.
+
+    Returns:
+        dict: Batch with the prompt, and the cache of the prompt for every row.
+    """
+    input_ids = batch["input_ids"]
+    size = input_ids.shape[0]
+    prefix = torch.tensor(prefix_ids, device=input_ids.device).expand(size, -1)
+    # The padding ends up between the prompt and the sentence, the model positions
+    # come from the attention mask so they skip it
+    batch["input_ids"] = torch.cat([prefix, input_ids], dim=1)
+    batch["attention_mask"] = torch.cat(
+        [torch.ones_like(prefix), batch["attention_mask"]], dim=1
+    )
+    # generate appends to the cache, so every batch gets a new one made of views
+    # of the prompt keys and values
+    batch["past_key_values"] = DynamicCache.from_legacy_cache(
+        tuple(
+            (key.expand(size, -1, -1, -1), value.expand(size, -1, -1, -1))
+            for key, value in prefix_cache
+        )
+    )
+    return batch
+
+
+def load_model(model_name: str, cache_dir: str = None, precision: str = "32"):
+    accelerator = Accelerator()
+
+    print(f"Loading tokenizer {model_name}...")
+    tokenizer = AutoTokenizer.from_pretrained(
+        pretrained_model_name_or_path=model_name,
+        cache_dir=cache_dir,
+        trust_remote_code="xgen" in model_name,
+        # pad_token="<|endoftext|>" if "xgen" in model_name else None,
+        use_fast="polylm" not in model_name,
+    )
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    # tokenizer.eos_token = eos_token
+
+    print(f"Loading model {model_name}...")
+    model = AutoModelForCausalLM.from_pretrained(
+        pretrained_model_name_or_path=model_name, cache_dir=cache_dir, torch_dtype=torch.bfloat16, device_map="auto" if "70b" in model_name else None, attn_implementation="flash_attention_2", 
+    )
+
+    model.eval()
+
+    model = accelerator.prepare(model)
+    return accelerator, tokenizer, model
+
+
+class TranslationSession:
+    """
+    Keeps the accelerator, tokenizer and model between calls to main, so that they
+    are loaded once to translate every field of every config of a dataset. They are
+    loaded by the first translation.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = None, precision: str = "32"):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.precision = precision
+        self.accelerator = None
+        self.tokenizer = None
+        self.model = None
+        self.prompt_caches = {}
+
+    def load(self):
+        if self.model is None:
+            self.accelerator, self.tokenizer, self.model = load_model(
+                self.model_name, self.cache_dir, self.precision
+            )
+        return self.accelerator, self.tokenizer, self.model
+
+    def prompt_cache(self, prompt: str):
+        # Keys and values of the prompt of a config, computed once for all its fields
+        if prompt not in self.prompt_caches:
+            accelerator, tokenizer, model = self.load()
+            # The last token of the prompt could merge with the start of the
+            # sentence, so it is encoded with the sentence
+            prefix_ids = tokenizer(prompt)["input_ids"][:-1]
+            with torch.no_grad():
+                past_key_values = model(
+                    input_ids=torch.tensor([prefix_ids], device=accelerator.device),
+                    use_cache=True,
+                ).past_key_values
+            if hasattr(past_key_values, "to_legacy_cache"):
+                past_key_values = past_key_values.to_legacy_cache()
+            self.prompt_caches[prompt] = (prefix_ids, past_key_values)
+        return self.prompt_caches[prompt]
+
+    def translate(self, **kwargs):
+        # Same arguments as main, the model ones are those of the session
+        return main(session=self, **kwargs)
+
+
 def main(
     source_lang: str,
     target_lang: str,
@@ -78,31 +200,21 @@ def main(
     output_path: str = None,
     sentences_list: str = None,
     return_output: bool = False,
+    keep_order: bool = False,
+    prompt: str = None,
+    session: TranslationSession = None,
 ):
     if not return_output:
         os.makedirs(os.path.abspath(os.path.dirname(output_path)), exist_ok=True)
 
-    accelerator = Accelerator()
-
-    print(f"Loading tokenizer {model_name}...")
-    tokenizer = AutoTokenizer.from_pretrained(
-        pretrained_model_name_or_path=model_name,
-        cache_dir=cache_dir,
-        trust_remote_code="xgen" in model_name,
-        # pad_token="<|endoftext|>" if "xgen" in model_name else None,
-        use_fast="polylm" not in model_name,
-    )
-    tokenizer.padding_side = "left"
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id
-    # tokenizer.eos_token = eos_token
-
-    print(f"Loading model {model_name}...")
-    model = AutoModelForCausalLM.from_pretrained(
-        pretrained_model_name_or_path=model_name, cache_dir=cache_dir, torch_dtype=torch.bfloat16, device_map="auto" if "70b" in model_name else None, attn_implementation="flash_attention_2", 
-    )
-
-    model.eval()
+    if session is None:
+        session = TranslationSession(model_name, cache_dir, precision)
+    elif (session.model_name, session.precision) != (model_name, precision):
+        raise ValueError(
+            f"The session holds {session.model_name} in {session.precision} precision, "
+            f"not {model_name} in {precision}"
+        )
+    accelerator, tokenizer, model = session.load()
 
     print(f"Preparing data...\n")
     
@@ -128,9 +240,29 @@ def main(
         "top_p": top_p,
     }
 
-    total_lines: int = (
-        count_lines(sentences_path) if sentences_list == None else len(sentences_list)
-    )
+    if sentences_list == None:
+        with open(sentences_path, encoding="utf-8") as f:
+            sentences_list = f.read().splitlines()
+    total_lines: int = len(sentences_list)
+
+    # Translate from the longest to the shortest sentence, so that batches need
+    # little padding, and put the translations back in order at the end
+    if keep_order:
+        order = list(range(total_lines))
+    else:
+        sentences_list, order = sort_by_length(sentences_list)
+
+    # Encode the prompt shared by every sentence once, and generate every batch
+    # from its keys and values
+    prefix_ids, prefix_cache = None, None
+    if prompt is not None:
+        if num_beams != 1 or num_return_sequences != 1:
+            raise ValueError(
+                "The prompt cache needs num_beams and num_return_sequences to be 1"
+            )
+        if not all(sentence.startswith(prompt) for sentence in sentences_list):
+            raise ValueError("Every sentence must start with the cached prompt")
+        prefix_ids, prefix_cache = session.prompt_cache(prompt)
 
     if accelerator.is_main_process:
         print(
@@ -144,44 +276,37 @@ def main(
             f"Num. Devices: {accelerator.num_processes}\n"
             f"Distributed_type: {accelerator.distributed_type}\n"
             f"Max length: {max_length}\n"
-            f"Precision: {model.dtype}\n"
+            f"Precision: {accelerator.unwrap_model(model).dtype}\n"
             f"Model: {model_name}\n"
+            f"Cached prompt tokens: {len(prefix_ids) if prompt is not None else 0}\n"
         )
         print("** Generation parameters **")
         print("\n".join(f"{k}: {v}" for k, v in gen_kwargs.items()))
         print("\n")
 
     def save_sentences(tgt_text: list):
-        nonlocal return_output, output_path
-        if return_output:
-            save_sentences.sentences.extend(tgt_text)
-        else:
-            print(
-                "\n".join(tgt_text),
-                file=save_sentences.f,
-            )
-
-    if not return_output:
-        save_sentences.f = open(output_path, "w", encoding="utf-8")
+        save_sentences.sentences.extend(tgt_text)
 
     @find_executable_batch_size(starting_batch_size=starting_batch_size)
     def inference(batch_size):
         nonlocal model, tokenizer, sentences_path, max_length, output_path, gen_kwargs, precision, sentences_list, return_output
 
         print(f"Translating with batch size {batch_size}")
-        translate_data = sentences_path if sentences_list == None else sentences_list
+        translate_data = sentences_list
         data_loader = get_dataloader(
             accelerator=accelerator,
             translate_data=translate_data,
             tokenizer=tokenizer,
             batch_size=batch_size,
             max_length=max_length,
+            prefix_ids=prefix_ids,
         )
 
-        model, data_loader = accelerator.prepare(model, data_loader)
+        data_loader = accelerator.prepare(data_loader)
 
         samples_seen: int = 0
 
+        # Start over if a larger batch size ran out of memory
         save_sentences.sentences = []
 
         with tqdm(
@@ -198,6 +323,9 @@ def main(
 
                     batch = {k: v for k, v in batch.items() if k != "token_type_ids"}
 
+                    if prefix_cache is not None:
+                        batch = add_prompt(batch, prefix_ids, prefix_cache)
+
                     generated_tokens = model.generate(**batch, **gen_kwargs)
 
                     generated_tokens = accelerator.pad_across_processes(
@@ -233,8 +361,18 @@ def main(
 
     inference()
     print(f"Translation done.\n")
+
+    # Only the main process gathers the translations
+    sentences = []
+    if accelerator.is_main_process:
+        sentences = restore_order(
+            save_sentences.sentences, order, num_return_sequences
+        )
+        if not return_output:
+            with open(output_path, "w", encoding="utf-8") as f:
+                print("\n".join(sentences), file=f)
     if return_output:
-        return save_sentences.sentences
+        return sentences
 
 
 if __name__ == "__main__":
@@ -367,6 +505,20 @@ if __name__ == "__main__":
         help="End of sentence token.",
     )
 
+    parser.add_argument(
+        "--keep_order",
+        action="store_true",
+        help="Translate the sentences in their original order, instead of sorting them by length to reduce padding.",
+    )
+
+    parser.add_argument(
+        "--prompt",
+        type=str,
+        default=None,
+        help="Prompt every sentence starts with. It is encoded once and every batch is generated "
+        "from its cached keys and values. Needs num_beams and num_return_sequences to be 1.",
+    )
+
     args = parser.parse_args()
 
     main(
@@ -388,4 +540,6 @@ if __name__ == "__main__":
         top_p=args.top_p,
         keep_special_tokens=args.keep_special_tokens,
         eos_token=args.eos_token,
+        keep_order=args.keep_order,
+        prompt=args.prompt,
     )
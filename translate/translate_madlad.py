@@ -14,7 +14,7 @@ from transformers import (
     DataCollatorForSeq2Seq,
 )
 
-from dataset import DatasetReader, count_lines
+from dataset import DatasetReader, restore_order, sort_by_length
 
 from accelerate import Accelerator, DistributedType, find_executable_batch_size
 
@@ -57,29 +57,7 @@ def get_dataloader(
     )
 
 
-def main(
-    source_lang: str,
-    target_lang: str,
-    starting_batch_size: int,
-    model_name: str = "facebook/m2m100_1.2B",
-    cache_dir: str = None,
-    precision: str = "32",
-    max_length: int = 128,
-    num_beams: int = 4,
-    num_return_sequences: int = 1,
-    do_sample: bool = False,
-    temperature: float = 1.0,
-    top_k: int = 50,
-    top_p: float = 1.0,
-    keep_special_tokens: bool = False,
-    sentences_path: str = None,
-    output_path: str = None,
-    sentences_list: str = None,
-    return_output: bool = False,
-):
-    if not return_output:
-        os.makedirs(os.path.abspath(os.path.dirname(output_path)), exist_ok=True)
-
+def load_model(model_name: str, cache_dir: str = None, precision: str = "32"):
     accelerator = Accelerator(
         mixed_precision=precision if precision != "32" else "no",
         split_batches=False,
@@ -97,8 +75,6 @@ def main(
 
     model.eval()
 
-    print(f"Preparing data...\n")
-
     if precision == "32":
         model = model.float()
     elif precision == "fp16":
@@ -108,6 +84,73 @@ def main(
     else:
         raise ValueError("Precision not supported. Supported values: 32, fp16, bf16")
 
+    model = accelerator.prepare(model)
+    return accelerator, tokenizer, model
+
+
+class TranslationSession:
+    """
+    Keeps the accelerator, tokenizer and model between calls to main, so that they
+    are loaded once to translate every field of every config of a dataset. They are
+    loaded by the first translation.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = None, precision: str = "32"):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.precision = precision
+        self.accelerator = None
+        self.tokenizer = None
+        self.model = None
+
+    def load(self):
+        if self.model is None:
+            self.accelerator, self.tokenizer, self.model = load_model(
+                self.model_name, self.cache_dir, self.precision
+            )
+        return self.accelerator, self.tokenizer, self.model
+
+    def translate(self, **kwargs):
+        # Same arguments as main, the model ones are those of the session
+        return main(session=self, **kwargs)
+
+
+def main(
+    source_lang: str,
+    target_lang: str,
+    starting_batch_size: int,
+    model_name: str = "facebook/m2m100_1.2B",
+    cache_dir: str = None,
+    precision: str = "32",
+    max_length: int = 128,
+    num_beams: int = 4,
+    num_return_sequences: int = 1,
+    do_sample: bool = False,
+    temperature: float = 1.0,
+    top_k: int = 50,
+    top_p: float = 1.0,
+    keep_special_tokens: bool = False,
+    sentences_path: str = None,
+    output_path: str = None,
+    sentences_list: str = None,
+    return_output: bool = False,
+    keep_order: bool = False,
+    session: TranslationSession = None,
+):
+    if not return_output:
+        os.makedirs(os.path.abspath(os.path.dirname(output_path)), exist_ok=True)
+
+    if session is None:
+        session = TranslationSession(model_name, cache_dir, precision)
+    elif (session.model_name, session.precision) != (model_name, precision):
+        raise ValueError(
+            f"The session holds {session.model_name} in {session.precision} precision, "
+            f"not {model_name} in {precision}"
+        )
+    accelerator, tokenizer, model = session.load()
+
+    print(f"Preparing data...\n")
+
     gen_kwargs = {
         "max_length": max_length,
         "num_beams": num_beams,
@@ -118,9 +161,17 @@ def main(
         "top_p": top_p,
     }
 
-    total_lines: int = (
-        count_lines(sentences_path) if sentences_list == None else len(sentences_list)
-    )
+    if sentences_list == None:
+        with open(sentences_path, encoding="utf-8") as f:
+            sentences_list = f.read().splitlines()
+    total_lines: int = len(sentences_list)
+
+    # Translate from the longest to the shortest sentence, so that batches need
+    # little padding, and put the translations back in order at the end
+    if keep_order:
+        order = list(range(total_lines))
+    else:
+        sentences_list, order = sort_by_length(sentences_list)
 
     if accelerator.is_main_process:
         print(
@@ -134,7 +185,7 @@ def main(
             f"Num. Devices: {accelerator.num_processes}\n"
             f"Distributed_type: {accelerator.distributed_type}\n"
             f"Max length: {max_length}\n"
-            f"Precision: {model.dtype}\n"
+            f"Precision: {accelerator.unwrap_model(model).dtype}\n"
             f"Model: {model_name}\n"
         )
         print("** Generation parameters **")
@@ -142,25 +193,16 @@ def main(
         print("\n")
 
     def save_sentences(tgt_text: list):
-        nonlocal return_output, output_path
-        if return_output:
-            save_sentences.sentences.extend(tgt_text)
-        else:
-            print(
-                "\n".join(tgt_text),
-                file=save_sentences.f,
-            )
-
-    if not return_output:
-        save_sentences.f = open(output_path, "w", encoding="utf-8")
-    save_sentences.sentences = []
+        save_sentences.sentences.extend(tgt_text)
 
     @find_executable_batch_size(starting_batch_size=starting_batch_size)
     def inference(batch_size):
         nonlocal model, tokenizer, sentences_path, max_length, output_path, gen_kwargs, precision, sentences_list, return_output
 
         print(f"Translating with batch size {batch_size}")
-        translate_data = sentences_path if sentences_list == None else sentences_list
+        # Start over if a larger batch size ran out of memory
+        save_sentences.sentences = []
+        translate_data = sentences_list
         data_loader = get_dataloader(
             accelerator=accelerator,
             translate_data=translate_data,
@@ -169,7 +211,7 @@ def main(
             max_length=max_length,
         )
 
-        model, data_loader = accelerator.prepare(model, data_loader)
+        data_loader = accelerator.prepare(data_loader)
 
         samples_seen: int = 0
 
@@ -222,8 +264,18 @@ def main(
 
     inference()
     print(f"Translation done.\n")
+
+    # Only the main process gathers the translations
+    sentences = []
+    if accelerator.is_main_process:
+        sentences = restore_order(
+            save_sentences.sentences, order, num_return_sequences
+        )
+        if not return_output:
+            with open(output_path, "w", encoding="utf-8") as f:
+                print("\n".join(sentences), file=f)
     if return_output:
-        return save_sentences.sentences
+        return sentences
 
 
 if __name__ == "__main__":
@@ -341,6 +393,12 @@ if __name__ == "__main__":
         help="Keep special tokens in the decoded text.",
     )
 
+    parser.add_argument(
+        "--keep_order",
+        action="store_true",
+        help="Translate the sentences in their original order, instead of sorting them by length to reduce padding.",
+    )
+
     args = parser.parse_args()
 
     main(
@@ -360,4 +418,5 @@ if __name__ == "__main__":
         top_k=args.top_k,
         top_p=args.top_p,
         keep_special_tokens=args.keep_special_tokens,
+        keep_order=args.keep_order,
     )
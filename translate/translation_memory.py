@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+from typing import Any, Callable, Dict, List
+
+from accelerate import PartialState
+
+# Arguments of the translation scripts that change the translations
+generation_args = [
+    "model_name",
+    "source_lang",
+    "target_lang",
+    "precision",
+    "max_length",
+    "max_new_tokens",
+    "num_beams",
+    "num_return_sequences",
+    "do_sample",
+    "keep_special_tokens",
+    "eos_token",
+]
+# Only used when sampling
+sampling_args = ["temperature", "top_k", "top_p"]
+
+
+class TranslationMemory:
+    """
+    On-disk memory of translations, so that sentences translated by a previous
+    run with the same model and generation arguments are not translated again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.state = PartialState()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "settings TEXT NOT NULL, source TEXT NOT NULL, translations TEXT NOT NULL, "
+            "PRIMARY KEY (settings, source))"
+        )
+
+    @staticmethod
+    def settings(translate_args: Dict[str, Any]) -> str:
+        """
+        Serializes the arguments that change the translations.
+
+        Args:
+            translate_args (Dict[str, Any]): Arguments of the translation script.
+
+        Returns:
+            str: Arguments as a json string with sorted keys.
+        """
+        keys = generation_args
+        if translate_args.get("do_sample"):
+            keys = keys + sampling_args
+        settings = {key: translate_args[key] for key in keys if key in translate_args}
+        return json.dumps(settings, sort_keys=True, ensure_ascii=False)
+
+    def get(self, settings: str, source: str) -> List[str]:
+        row = self.db.execute(
+            "SELECT translations FROM translations WHERE settings = ? AND source = ?",
+            (settings, source),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, settings: str, source: str, translations: List[str]):
+        self.db.execute(
+            "INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+            (settings, source, json.dumps(translations, ensure_ascii=False)),
+        )
+
+    def translate(
+        self,
+        translate_fn: Callable[..., List[str]],
+        sentences: List[str],
+        translate_args: Dict[str, Any],
+    ) -> List[str]:
+        """
+        Translates the sentences that are not in the memory and stores their translations.
+
+        Args:
+            translate_fn (Callable[..., List[str]]): main function of a translation script, or the
+                translate method of its session.
+            sentences (List[str]): Sentences to translate.
+            translate_args (Dict[str, Any]): Arguments of the translation script.
+
+        Returns:
+            List[str]: num_return_sequences translations of each sentence, in order.
+            Empty on the processes other than the main one, as translate_fn.
+        """
+        num_return_sequences = translate_args["num_return_sequences"]
+        settings = self.settings(translate_args)
+        found = {}
+        for sentence in sentences:
+            translations = self.get(settings, sentence)
+            if translations is not None:
+                found[sentence] = translations
+        missing = [sentence for sentence in sentences if sentence not in found]
+        self.hits += len(sentences) - len(missing)
+        self.misses += len(missing)
+        print(f"{len(sentences) - len(missing)} sentences found in the translation memory")
+
+        if missing:
+            # Every process sees the same memory, so all of them take part in the translation
+            translations = translate_fn(
+                sentences_list=missing, return_output=True, **translate_args
+            )
+            if self.state.is_main_process:
+                with self.db:
+                    self.db.execute("BEGIN")
+                    for i, sentence in enumerate(missing):
+                        found[sentence] = translations[
+                            i * num_return_sequences : (i + 1) * num_return_sequences
+                        ]
+                        self.put(settings, sentence, found[sentence])
+            # Keep the others from reading the memory before it is written
+            self.state.wait_for_everyone()
+            if not self.state.is_main_process:
+                return []
+        return [translation for sentence in sentences for translation in found[sentence]]
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        print(
+            f"Translation memory {self.path}: {self.hits} hits, {self.misses} misses "
+            f"({rate:.1%} hit rate)"
+        )